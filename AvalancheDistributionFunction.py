@@ -13,16 +13,30 @@ where
 """
 
 import numpy as np
-import numpy.matlib
 from DistributionFunction import DistributionFunction
 
 np.seterr(divide='ignore', invalid='ignore')
 
 class AvalancheDistributionFunction(DistributionFunction):
+
+    NPARAMS = 3
+
     def __init__(self, nr, rmin, rmax, greenRadialGrid):
         super().__init__(nr, rmin, rmax, greenRadialGrid)
 
-    def Eval(self, r, ppar, pperp, v, gamma=None, p=None, p2=None, xi=None):
+    def Prepare(self, gamma, p2, p, xi):
+        """
+        Pre-compute the parameter-independent factor g/p^2,
+        as well as the momentum dependence of the exponent,
+        stacked as the rows of the (2, nmomentum) array
+        [g*(1 - xi); g].
+        """
+        GP2 = gamma / p2
+        B = np.concatenate((gamma*(1 - xi), gamma), axis=0)
+
+        return GP2, B
+
+    def Eval(self, r, ppar, pperp, v, gamma=None, p=None, p2=None, xi=None, out=None):
         """
         Evaluate the avalanche distribution function defined by the
         vector 'v' in the point(s) given by (r, ppar, pperp).
@@ -31,21 +45,90 @@ class AvalancheDistributionFunction(DistributionFunction):
           [a0,a1,...,an,b0,b1,...,bn,c0,c1,...,cn]
         where the index corresponds to the given radii.
         """
-        V = self.PreprocessInputVector(v, r.size, nparams=3)
+        V = self.PreprocessInputVector(v, nparams=self.NPARAMS)
+        return self.EvalParameters(V, ppar, pperp, gamma=gamma, p=p, p2=p2, xi=xi, out=out)
 
+    def EvalParameters(self, V, ppar, pperp, gamma=None, p=None, p2=None, xi=None, out=None):
+        """
+        Evaluate the avalanche distribution function for the
+        pre-processed parameters V = [a; b; c], of shape (3, nr, 1).
+        """
+        # Per-radius parameters, shape (nr, 1)
         a = V[0,:]
         b = V[1,:]
         c = V[2,:]
 
-        if p2 is None:    p2    = ppar**2 + pperp**2
-        if p is None:     p     = np.sqrt(p2)
-        if gamma is None: gamma = np.sqrt(1 + p2)
-        if xi is None:    xi    = ppar / p
+        GP2, B = self.GetInvariants(ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+        f = out
+        if f is None:
+            f = np.empty((a.shape[0], B.shape[1]))
 
-        f = a*b/c * gamma / p**2 * np.exp(-gamma/c - a*gamma*(1 - xi))
+        # The exponent -a*g*(1 - xi) - g/c is formed directly
+        # in 'f' as the product of an (nr, 2) and a (2, nmomentum)
+        # matrix, and the remaining factors are applied in-place
+        np.matmul(np.concatenate((-a, -1/c), axis=1), B, out=f)
+        np.exp(f, out=f)
+        f *= GP2
+        f *= a*b/c
 
         return f
 
+    def EvalParametersGradient(self, V, Q, ppar, pperp, gamma=None, p=None, p2=None, xi=None):
+        """
+        Evaluate the gradient of sum(Q*f) with respect to the
+        pre-processed parameters V = [a; b; c]. Writing the
+        distribution function as f = a*b/c * E, where
+        E = g/p^2 * exp[-g/c - a*g*(1 - xi)],
+
+          df/da = (b/c - a*b/c * g*(1 - xi)) * E
+          df/db = a/c * E
+          df/dc = (a*b/c^3 * g - a*b/c^2) * E
+        """
+        a = V[0,:]
+        b = V[1,:]
+        c = V[2,:]
+
+        GP2, B = self.GetInvariants(ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+        QE = np.matmul(np.concatenate((-a, -1/c), axis=1), B)
+        np.exp(QE, out=QE)
+        QE *= GP2
+        QE *= Q
+
+        # Sums over momentum of Q*E, Q*E*g*(1 - xi) and Q*E*g
+        S0 = np.sum(QE, axis=1, keepdims=True)
+        S = np.matmul(QE, B.T)
+
+        G = np.empty((3,) + a.shape)
+        G[0] = (b/c)*S0 - (a*b/c)*S[:,0:1]
+        G[1] = (a/c)*S0
+        G[2] = (a*b/c**3)*S[:,1:2] - (a*b/c**2)*S0
+
+        return G
+
+    def EvalSeparable(self, r, ppar, pperp, v, gamma=None, p=None, p2=None, xi=None):
+        """
+        Evaluate the avalanche distribution function in separated
+        form f = s(r) * g(p), which is possible when 'a' and 'c'
+        are the same at every radius (so that only 'b' varies).
+        Returns (s, g), or None if the function is not separable.
+        """
+        V = self.PreprocessInputVector(v, nparams=self.NPARAMS)
+
+        if not self.IsConstantInRadius(V[[0,2],:]):
+            return None
+
+        a = V[0,0,0]
+        b = V[1,:,0]
+        c = V[2,0,0]
+
+        GP2, B = self.GetInvariants(ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+        g = (a/c) * GP2[0,:] * np.exp(-a*B[0,:] - B[1,:]/c)
+
+        return b, g
+
 ########################
 # Unit test
 ########################
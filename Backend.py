@@ -0,0 +1,244 @@
+# Abstract base class for execution backends
+#
+# A backend provides the communication primitives used by smul
+# (through the SMPI module), as well as the means of carrying out
+# the Green's function multiplication on the processes it manages.
+
+from abc import ABC, abstractmethod
+import numpy as np
+
+from SmulException import SmulException
+
+ROOT_PROC = 0
+
+# Reduction operations
+SUM = 'sum'
+MIN = 'min'
+MAX = 'max'
+
+class Backend(ABC):
+
+    @abstractmethod
+    def abort(self):
+        """
+        Abort execution on all processes.
+        """
+        pass
+
+    @abstractmethod
+    def allgather(self, value):
+        """
+        Gather the (pickleable) value 'value' from all processes
+        and return the list of values (ordered by rank) on all
+        processes.
+        """
+        pass
+
+    @abstractmethod
+    def allreduce(self, value, op):
+        """
+        Reduce the (pickleable) value 'value' over all
+        processes using the operation 'op' (SUM, MIN or MAX)
+        and return the result on all processes.
+        """
+        pass
+
+    @abstractmethod
+    def Bcast(self, buf, root=ROOT_PROC):
+        """
+        Broadcast the contents of the NumPy array 'buf'
+        from the process 'root' to all other processes. On
+        the other processes, 'buf' must be preallocated
+        with the correct shape.
+        """
+        pass
+
+    @abstractmethod
+    def Ibcast(self, buf, root=ROOT_PROC):
+        """
+        Non-blocking version of 'Bcast()'. Returns a request
+        which must be completed with 'wait()' before 'buf'
+        is used.
+        """
+        pass
+
+    @abstractmethod
+    def Ireduce(self, sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+        """
+        Non-blocking version of 'Reduce()' (which is never done
+        in-place). Returns a request which must be completed
+        with 'wait()' before either of the buffers is touched.
+        """
+        pass
+
+    @abstractmethod
+    def nproc(self):
+        """
+        Returns the number of processes taking part in the run.
+        """
+        pass
+
+    @abstractmethod
+    def rank(self):
+        """
+        Returns the rank of this process.
+        """
+        pass
+
+    @abstractmethod
+    def recv(self, src, tag):
+        """
+        Receive a pickled object from process 'src'.
+        """
+        pass
+
+    @abstractmethod
+    def Recv(self, buf, src, tag):
+        """
+        Receive a NumPy array into the (preallocated) buffer
+        'buf' without any serialization.
+        """
+        pass
+
+    @abstractmethod
+    def Reduce(self, sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+        """
+        Reduce the NumPy arrays 'sendbuf' over all processes
+        using the operation 'op', storing the result in
+        'recvbuf' on the process 'root'. 'recvbuf' is
+        ignored on all other processes. If 'recvbuf' is the
+        same array as 'sendbuf', the reduction is done in-place.
+        """
+        pass
+
+    @abstractmethod
+    def send(self, data, dest, tag):
+        """
+        Send the (pickleable) object 'data' to process 'dest'.
+        """
+        pass
+
+    @abstractmethod
+    def Send(self, buf, dest, tag):
+        """
+        Send the contiguous NumPy array 'buf' without
+        any serialization.
+        """
+        pass
+
+    def group(self):
+        """
+        Returns the index of the replica group this
+        process belongs to. All processes of a replica
+        group together hold a complete Green's function.
+        """
+        return 0
+
+    def ngroups(self):
+        """
+        Returns the number of replica groups.
+        """
+        return 1
+
+    def groupRoot(self, group):
+        """
+        Returns the world rank of the root process
+        of the given replica group.
+        """
+        return ROOT_PROC
+
+    def worldRank(self):
+        """
+        Returns the rank of this process among all
+        processes (in all replica groups).
+        """
+        return self.rank()
+
+    def IrecvWorld(self, buf, src, tag):
+        """
+        Post a non-blocking receive of a NumPy array from
+        the process with world rank 'src'. Returns a request.
+        """
+        raise SmulException("This backend does not support replica groups.")
+
+    def RecvWorld(self, buf, src, tag):
+        """
+        Receive a NumPy array from the process with world
+        rank 'src' into the (preallocated) buffer 'buf'.
+        """
+        raise SmulException("This backend does not support replica groups.")
+
+    def SendWorld(self, buf, dest, tag):
+        """
+        Send the NumPy array 'buf' to the process
+        with world rank 'dest'.
+        """
+        raise SmulException("This backend does not support replica groups.")
+
+    def waitany(self, requests):
+        """
+        Wait for any of the given requests to complete.
+        Returns the index of the completed request.
+        """
+        raise SmulException("This backend does not support replica groups.")
+
+    def allocateShared(self, key, shape, dtype):
+        """
+        Allocate an array which may be shared with other
+        processes that allocate an array with the same key.
+        Returns a tuple (array, fill), where 'fill' is True
+        on exactly one of the processes sharing the array,
+        which must then fill it with data. Other processes
+        may only read the array after 'synchronizeShared()'
+        has been called. By default, arrays are not shared.
+
+        key:   String identifying the contents of the array.
+        shape: Shape of the array.
+        dtype: Data type of the array elements.
+        """
+        return np.empty(shape, dtype=dtype), True
+
+    def synchronizeShared(self):
+        """
+        Wait until all shared arrays have been filled.
+        """
+        pass
+
+    def wait(self, request):
+        """
+        Wait for the given non-blocking request to complete.
+        """
+        if request is not None:
+            request.Wait()
+
+    def setup(self, green, distribution):
+        """
+        Prepare the backend for multiplying the given Green's
+        function with the given distribution function. Called
+        once the Green's function has been loaded.
+
+        green:        GreensFunction loaded by this process.
+        distribution: DistributionFunction to evaluate.
+        """
+        pass
+
+    def finalize(self):
+        """
+        Release any resources held by the backend.
+        """
+        pass
+
+    def multiply(self, green, distribution, v):
+        """
+        Multiply the Green's function of this process with
+        the distribution function specified by 'v'.
+        """
+        return green.multiply(distribution, v)
+
+    def multiplyBatch(self, green, distribution, V):
+        """
+        Multiply the Green's function of this process with
+        the batch of distribution functions specified by 'V'.
+        """
+        return green.multiplyBatch(distribution, V)
+
@@ -2,27 +2,79 @@
 
 from abc import ABC, abstractmethod
 import numpy as np
+import scipy.sparse
 import smutil
 import SMPI
 
 class DistributionFunction(ABC):
 
+    # Number of parameters (per radius) in the input vector
+    NPARAMS = 0
+
     def __init__(self, nr, rmin, rmax, greenRadialGrid):
         #rmin = np.amin(greenRadialGrid)
         #rmax = np.amax(greenRadialGrid)
         self.radialGrid      = np.linspace(rmin, rmax, nr)
+        self.setGreenRadialGrid(greenRadialGrid)
+
+        # Parameter-independent quantities (see 'GetInvariants()')
+        self.invariants     = None
+        self.invariantsGrid = None
+
+    def setGreenRadialGrid(self, greenRadialGrid):
+        """
+        Set the radial grid of the Green's function that
+        this distribution function is evaluated on.
+
+        greenRadialGrid: Radial grid of the Green's function.
+        """
         self.greenRadialGrid = greenRadialGrid
+        self.interpolation   = self.ConstructInterpolationOperator(self.radialGrid, greenRadialGrid)
+
+    @staticmethod
+    def ConstructInterpolationOperator(x, xg):
+        """
+        Construct the sparse matrix W of shape (xg.size, x.size)
+        which linearly interpolates values given on the grid 'x'
+        onto the grid 'xg', so that W @ y == np.interp(xg, x, y).
+        Points outside of 'x' take the value at the nearest end.
+
+        x:  Grid to interpolate from (increasing).
+        xg: Grid to interpolate to.
+        """
+        x  = np.asarray(x, dtype=np.float64)
+        xg = np.asarray(xg, dtype=np.float64).flatten()
+        N, n = x.size, xg.size
+
+        if N == 1:
+            return scipy.sparse.csr_matrix(np.ones((n, 1)))
+
+        # Interval containing each point, and the relative
+        # position of the point within that interval
+        j  = np.clip(np.searchsorted(x, xg, side='right') - 1, 0, N-2)
+        dx = x[j+1] - x[j]
+        t  = np.divide(xg - x[j], dx, out=(xg >= x[j+1]).astype(np.float64), where=(dx != 0))
+        t  = np.clip(t, 0, 1)
+
+        rows = np.concatenate((np.arange(n), np.arange(n)))
+        cols = np.concatenate((j, j+1))
+        vals = np.concatenate((1-t, t))
+
+        return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(n, N))
     
     @abstractmethod
-    def Eval(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None):
+    def Eval(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None, out=None):
         """
         Evaluate the given distribution function in the point(s)
         (r, ppar, pperp). Use the vector 'v' to specify the
         parameters of this distribution function.
 
-        r:     Radial point(s) to evaluate the distribution function in.
-        ppar:  Parallel momentum point(s) to evaluate the distribution function in.
-        pperp: Perpendicular momentum point(s) to evaluate the distribution function in.
+        r:     Radial point(s) to evaluate the distribution function in
+               (shape (nr, 1)).
+        ppar:  Parallel momentum point(s) to evaluate the distribution function in
+               (shape (1, nmomentum)).
+        pperp: Perpendicular momentum point(s) to evaluate the distribution function in
+               (shape (1, nmomentum)).
         v:     Vector of parameters (specific to each distribution function type)
 
         (Optional arguments)
@@ -30,51 +82,157 @@ class DistributionFunction(ABC):
         p2:    Pre-computed vector corresponding to ppar**2 + pperp**2
         p:     Pre-computed vector corresponding to sqrt(ppar**2 + pperp**2)
         xi:    Pre-computed vector corresponding to ppar/sqrt(ppar**2 + pperp**2)
+        out:   Array of shape (nr, nmomentum) to store the result in.
+               If None, a new array is allocated.
 
         NOTE 1: Momentum is given units of mc (electron mass times
                 the speed of light)
-        NOTE 2: The length of r, ppar and pperp must be the same, while
-                the length of v must be len(r)*number-of-parameters
+        NOTE 2: r must be broadcastable against ppar and pperp, so that
+                the distribution function is returned as an array of
+                shape (nr, nmomentum). Momentum-only quantities are
+                thus only computed once per momentum point. The
+                length of v must be (interface nr)*number-of-parameters
         """
         while False:
             yield None
+
+    @abstractmethod
+    def EvalParameters(self, V, ppar, pperp, gamma=None, p2=None, p=None, xi=None, out=None):
+        """
+        Evaluate the distribution function for the pre-processed
+        parameters 'V' (as returned by 'GetParameters()'), which
+        may be given at any subset of the radial points. Returns
+        an array of shape (V.shape[1], nmomentum).
+
+        Takes the same optional arguments as 'Eval()'.
+        """
+
+    @abstractmethod
+    def EvalParametersGradient(self, V, Q, ppar, pperp, gamma=None, p2=None, p=None, xi=None):
+        """
+        Evaluate the gradient of sum(Q*f) with respect to the
+        pre-processed parameters 'V' (see 'EvalParameters()'),
+        where f is the distribution function and 'Q' is an array
+        of shape (V.shape[1], nmomentum) (e.g. an image residual
+        back-projected through the Green's function). Returns an
+        array of shape (NPARAMS, V.shape[1], 1).
+
+        Takes the same optional arguments as 'Eval()'.
+        """
+
+    def EvalSeparable(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None):
+        """
+        Evaluate the distribution function in separated form, i.e.
+        as f(r, p) = s(r) * g(p), where only the amplitude s(r)
+        depends on radius. This is possible when all parameters
+        determining the momentum-space shape are the same at
+        every radius.
+
+        Takes the same arguments as 'Eval()'. Returns the tuple
+        (s, g), where s has shape (nr,) and g has shape
+        (nmomentum,), or None if the distribution function
+        defined by 'v' is not separable.
+        """
+        return None
+
+    def Prepare(self, gamma, p2, p, xi):
+        """
+        Pre-compute quantities which do not depend on the
+        parameters of the distribution function, on the given
+        momentum grid (all arguments of shape (1, nmomentum)).
+        The returned object is cached by 'GetInvariants()'.
+        By default, nothing is pre-computed.
+        """
+        return None
+
+    def GetInvariants(self, ppar, pperp, gamma=None, p2=None, p=None, xi=None):
+        """
+        Returns the parameter-independent quantities computed
+        by 'Prepare()' on the given momentum grid. When the
+        pre-computed momentum quantities of the Green's function
+        grid are given, the quantities are only computed on the
+        first call and then re-used for as long as the same grid
+        is passed.
+        """
+        if gamma is not None and gamma is self.invariantsGrid:
+            return self.invariants
+
+        grid = gamma
+        if p2 is None:    p2    = ppar**2 + pperp**2
+        if p is None:     p     = np.sqrt(p2)
+        if gamma is None: gamma = np.sqrt(1 + p2)
+        if xi is None:    xi    = ppar / p
+
+        invariants = self.Prepare(gamma, p2, p, xi)
+        if grid is not None:
+            self.invariants, self.invariantsGrid = invariants, grid
+
+        return invariants
+
+    def GetParameters(self, v):
+        """
+        Returns the parameters specified by the input vector 'v'
+        on the radial grid of the Green's function, as an array of
+        shape (NPARAMS, nr, 1) (see 'PreprocessInputVector()').
+        """
+        if self.NPARAMS == 0:
+            return np.zeros((0, self.greenRadialGrid.size, 1))
+        else:
+            return self.PreprocessInputVector(v, nparams=self.NPARAMS)
+
+    def IsConstantInRadius(self, V):
+        """
+        Check whether the given pre-processed parameters
+        take the same value at every radius.
+
+        V: Pre-processed parameters (of shape (k, nr, 1)).
+        """
+        return np.all(V == V[:,:1,:])
     
-    def PreprocessInputVector(self, v, n, nparams):
+    def PreprocessInputVector(self, v, nparams):
         """
         Pre-process the input vector to give it a shape appropriate
-        for generating the distribution
-
-        v:    Input vector to reshape
-        n:    Number of coordinates in grid
-        npar: Number of parameters in model
+        for generating the distribution. The parameters are returned
+        as an array of shape (nparams, nr, 1), where nr is the number
+        of radial points in the Green's function grid, so that each
+        parameter broadcasts against the momentum grid. All parameters
+        are interpolated at once using the pre-computed (sparse)
+        interpolation operator.
+
+        v:       Input vector to reshape
+        nparams: Number of parameters in model
         """
-        l = v.size
-        if l % nparams is not 0:
-            smutil.error("AvalancheDistributionFunction: Input vector has invalid format: length is not a multiple of "+str(nparams)+" (number of parameters in model).")
+        v = np.asarray(v)
+        if v.size % nparams != 0:
+            smutil.error(type(self).__name__+": Input vector has invalid format: length is not a multiple of "+str(nparams)+" (number of parameters in model).")
 
         # Number of radial points in interface grid
         NR = self.radialGrid.size
 
         # Number of radial points in internal grid
         nr = self.greenRadialGrid.size
-        nv = int(n/nr)
 
-        abc = np.reshape(v, (nparams, NR))
+        if v.size != nparams*NR:
+            smutil.error(type(self).__name__+": Input vector has invalid format: expected "+str(nparams)+" parameters on "+str(NR)+" radial points.")
 
         # Interpolate onto Green's function's radial grid
-        a = np.interp(self.greenRadialGrid, self.radialGrid, abc[0,:])
-        b = np.interp(self.greenRadialGrid, self.radialGrid, abc[1,:])
-        c = np.interp(self.greenRadialGrid, self.radialGrid, abc[2,:])
+        V = self.interpolation @ np.reshape(v, (nparams, NR)).T
 
-        a = np.matlib.repmat(a, nv, 1).T
-        b = np.matlib.repmat(b, nv, 1).T
-        c = np.matlib.repmat(c, nv, 1).T
+        return np.reshape(V.T, (nparams, nr, 1))
 
-        a = np.reshape(a, (1,nv*nr))
-        b = np.reshape(b, (1,nv*nr))
-        c = np.reshape(c, (1,nv*nr))
+    def PreprocessInputVectorAdjoint(self, G):
+        """
+        Pull a gradient with respect to the pre-processed parameters
+        back to a gradient with respect to the input vector, i.e.
+        apply the transpose of 'PreprocessInputVector()'.
 
-        abc = np.array([a,b,c])
+        G: Gradient with respect to the pre-processed parameters,
+           of shape (nparams, nr, 1).
+
+        RETURNS a vector with the layout of the input vector.
+        """
+        nparams, nr = G.shape[0], G.shape[1]
+        g = self.interpolation.T @ np.reshape(G, (nparams, nr)).T
 
-        return abc
+        return np.reshape(g.T, (nparams*self.radialGrid.size,))
 
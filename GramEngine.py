@@ -0,0 +1,127 @@
+# Likeness engine based on the Gram matrix of the Green's function
+#
+# The image is linear in the distribution function, I = G f, and the
+# likeness is the mean-squared error against the real image R. Hence
+#
+#   MSE = (f^T G^T G f - 2 f^T G^T R + R^T R) / npixels^2
+#
+# (where only the pixels in the pixel mask are counted, if one is set).
+# More generally, with a weight W_i for each pixel (e.g. w_k / npixels_k
+# for the pixels of diagnostic k, when the likeness is a weighted sum
+# over several diagnostics),
+#
+#   Sum_i W_i (I_i - R_i)^2 = f^T G^T W G f - 2 f^T G^T W R + R^T W R
+#
+# With G^T W G and G^T W R computed once at startup, every likeness
+# evaluation only requires a quadratic form in phase-space, and no
+# image needs to be formed or gathered on the root process.
+#
+# The Gram matrix is distributed by rows: the process holding the
+# columns G_r of the Green's function (its radial block) stores the
+# rows G_r^T W G of the Gram matrix.
+
+import numpy as np
+import scipy.sparse
+
+import SMPI
+from GreensFunction import CHUNK_SIZE
+
+class GramEngine:
+
+    def __init__(self, green, distribution, image, weights):
+        """
+        Constructor. Must be called collectively by all processes.
+
+        green:        Green's function of this process.
+        distribution: Distribution function to evaluate.
+        image:        Real image to compare to (on all processes),
+                      as a vector in the format returned by
+                      'green.maskImage()'.
+        weights:      Weight of each pixel in the likeness (a vector
+                      of the same length as 'image').
+        """
+        self.green = green
+        self.distribution = distribution
+
+        FUNC = green.getFunction()
+        npixels2, n = FUNC.shape
+
+        self.sizes = SMPI.allgather(n)
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes))).astype(np.int64)
+
+        R = np.reshape(np.asarray(image, dtype=np.float64), (npixels2,))
+        self.W = np.reshape(np.asarray(weights, dtype=np.float64), (npixels2,))
+        self.GR = (self.W * R).astype(FUNC.dtype) @ FUNC
+        self.RR = np.dot(R, self.W * R)
+
+        self.H = self.constructGram(FUNC)
+
+    def constructGram(self, FUNC):
+        """
+        Construct the rows G_r^T W G of the Gram matrix belonging
+        to this process. The column blocks of the other processes
+        are broadcast in turn, in pieces of at most CHUNK_SIZE bytes.
+        """
+        npixels2, n = FUNC.shape
+        H = np.empty((n, self.offsets[-1]))
+
+        step = max(1, CHUNK_SIZE // (npixels2*FUNC.itemsize))
+        for s in range(0, SMPI.nproc()):
+            for j0 in range(0, self.sizes[s], step):
+                j1 = min(self.sizes[s], j0+step)
+
+                buf = SMPI.getBuffer('gramblock', (j1-j0, npixels2), dtype=FUNC.dtype)
+                if s == SMPI.rank():
+                    cols = FUNC[:,j0:j1]
+                    buf[:] = (cols.toarray() if scipy.sparse.issparse(cols) else np.asarray(cols)).T
+
+                SMPI.Bcast(buf, root=s)
+
+                # (with the block on the left, a low-rank or streamed
+                # FUNC is multiplied through its '__rmatmul__()', and
+                # a sparse FUNC through the sparse product, so that
+                # FUNC is never converted to a dense array)
+                o = self.offsets[s]
+                H[:,(o+j0):(o+j1)] = ((buf * self.W.astype(buf.dtype)) @ FUNC).T
+
+        return H
+
+    def evaluate(self, v):
+        """
+        Compute the likeness of the image resulting from the
+        vector 'v' to the real image. Must be called collectively
+        by all processes, and returns the likeness on all of them.
+
+        v: Vector of parameters specifying the shape
+           of the distribution function.
+        """
+        f = np.reshape(self.green.evalDistribution(self.distribution, v), (self.GR.size,))
+        F = np.concatenate(SMPI.allgather(f))
+
+        q = np.dot(f, np.matmul(self.H, F)) - 2*np.dot(f, self.GR)
+        q = SMPI.allreduce(q, SMPI.SUM)
+
+        return q + self.RR
+
+    def evaluateBatch(self, V):
+        """
+        Compute the likeness values corresponding to each of the
+        vectors (rows) in 'V'. Must be called collectively by all
+        processes, and returns the likeness values on all of them.
+
+        V: Array of shape (k, len(v)), with each row being a vector
+           of parameters specifying the shape of a distribution function.
+        """
+        V = np.atleast_2d(V)
+        k, n = V.shape[0], self.GR.size
+
+        F = np.empty((k, n))
+        for i in range(0, k):
+            self.green.evalDistribution(self.distribution, V[i], out=np.reshape(F[i], self.green.getPhaseSpace().getShape()))
+
+        Fall = np.concatenate(SMPI.allgather(F), axis=1)
+
+        q = np.sum(F * np.matmul(Fall, self.H.T), axis=1) - 2*np.matmul(F, self.GR)
+        q = SMPI.allreduce(q, SMPI.SUM)
+
+        return q + self.RR
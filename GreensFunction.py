@@ -1,33 +1,148 @@
 
+import concurrent.futures
+import copy
 import h5py
+import json
 import numpy as np
-import numpy.matlib
+import os.path
+import scipy.sparse
+import struct
+import zlib
+from LowRankFunction import LowRankFunction
+from PhaseSpace import PhaseSpace
+from StreamedFunction import StreamedFunction
+
+# Number of bytes of the Green's function to read
+# from disk at a time in 'chunked' load mode
+CHUNK_SIZE = 64*1024*1024
+
+# Available modes for loading the Green's function
+LOAD_MODES = ['memory', 'chunked', 'mmap', 'stream']
+
+# Available precisions for storing and multiplying
+# with the Green's function (see 'setPrecision()')
+PRECISIONS = ['double', 'single', 'mixed']
+
+# Largest fraction of non-zero elements for which the
+# Green's function is stored as a sparse matrix when
+# the choice is made automatically (see 'sparsify()')
+SPARSE_DENSITY = 0.25
+
+# Largest number of pruned columns between two runs of kept
+# columns for which the runs are multiplied as one (see
+# 'contractPruned()')
+PRUNE_GAP = 32
+
+# Precompiled Green's function cache files (see 'saveCache()')
+CACHE_MAGIC = b'SMULGF\0\0'
+CACHE_VERSION = 1
+# Alignment (in bytes) of the arrays in a cache file
+CACHE_ALIGNMENT = 64
 
 class GreensFunction:
     
-    def __init__(self, filename):
+    def __init__(self, filename, loadmode='memory', radialRange=None, allocate=None, verify=False, budget=None, dtype=None, mask=None):
         """
         Constructor
+
+        filename:    Name of Green's function file to load.
+        loadmode:    How to load the Green's function matrix. Either
+                     'memory' (read everything in one go), 'chunked'
+                     (read in blocks into a row-major pixel x phase-space
+                     array), 'mmap' (memory-map the matrix directly
+                     from disk) or 'stream' (keep the matrix on disk and
+                     stream it through memory in every multiplication;
+                     see 'StreamedFunction').
+        radialRange: Tuple (i0, i1) specifying that only the radial
+                     points i0 <= i < i1 of the Green's function should
+                     be loaded. If None, all radial points are loaded.
+        allocate:    Function allocate(key, shape, dtype) used to
+                     allocate the arrays of the Green's function. The
+                     function should return a tuple (array, fill),
+                     where 'fill' indicates whether this process is
+                     responsible for filling the array with data. Arrays
+                     allocated with the same key may be shared between
+                     processes (see 'SMPI.allocateShared()'). If None,
+                     all arrays are allocated locally.
+        verify:      If True, and the file is a precompiled cache (see
+                     'saveCache()'), verify the checksums of the loaded
+                     part of the matrix (the header and grids of a cache
+                     are always verified).
+        budget:      Memory budget (in bytes) for the blocks read in
+                     'stream' load mode (see 'StreamedFunction').
+        dtype:       Data type to store the matrix in. If None, the
+                     data type of the file is used.
+        mask:        Pixel mask, of shape (npixels, npixels), which is
+                     non-zero in the pixels to load (see 'setPixelMask()').
+                     Only the rows of the matrix for these pixels are
+                     read and stored. As they are scattered over the
+                     file, they are read into memory (rather than being
+                     memory-mapped) in 'mmap' load mode. If None, all
+                     pixels are loaded.
         """
-        self.nr = None
-        self.smallR = None
-        self.R = None
-        self.PPAR = None
-        self.PPERP = None
-        self.GAMMA = None
-        self.XI = None
-        self.P = None
-        self.P2 = None
+        self.phaseSpace = None
         self.FUNC = None
+        # Key identifying the contents of the matrix (see 'allocate')
+        self.matrixKey = None
+        # Indices of the pixels to compute (or None for all)
+        self.pixelMask = None
+        # Number of pixels and pixel mask of each diagnostic, and
+        # the offsets of their rows in the matrix, if the matrices
+        # of several diagnostics have been stacked (see 'stack()')
+        self.diagnostics = None
+        self.diagnosticOffsets = None
+        # Number of incremental updates between full
+        # recomputations of the image (or None to disable
+        # incremental updates; see 'setIncremental()')
+        self.refresh = None
+        self.resetIncremental()
+        # Number of phase-space points to evaluate and multiply
+        # at a time (or None to evaluate the whole distribution
+        # function at once; see 'setBlocking()')
+        self.blockSize = None
+        self.threads = 1
+        self.executor = None
+        # Precision of the computations (see 'setPrecision()'), and
+        # data type which distribution functions are evaluated in
+        self.precision = 'double'
+        self.evalDtype = np.float64
+        # Largest relative error allowed when pruning columns of
+        # the matrix (or None to disable pruning), the L1 norms of
+        # the columns, and the error bound of the last evaluation
+        # (see 'setPruning()')
+        self.pruning = None
+        self.columnNorms = None
+        self.pruningError = 0.0
+        # Buffer which distribution functions are evaluated into
+        self.workspace = None
+
+        if loadmode not in LOAD_MODES:
+            raise ValueError("Unrecognized Green's function load mode: '"+loadmode+"'.")
 
-        self.loadHDF5(filename)
+        self.budget = budget
+        self.dtype = dtype
+        self.loadMask = mask
+        if GreensFunction.isCache(filename):
+            self.loadCache(filename, loadmode, radialRange, allocate, verify)
+        else:
+            self.loadHDF5(filename, loadmode, radialRange, allocate)
 
-    def loadHDF5(self, filename):
+    def loadHDF5(self, filename, loadmode='memory', radialRange=None, allocate=None):
         """
         Loads the Green's function file
         with the given name using h5py.
+
+        filename:    Name of Green's function file to load.
+        loadmode:    How to load the Green's function matrix
+                     (see the constructor).
+        radialRange: Range of radial points to load
+                     (see the constructor).
+        allocate:    Array allocation function (see the constructor).
         """
-        matfile = h5py.File(filename)
+        if allocate is None:
+            allocate = lambda key, shape, dtype: (np.empty(shape, dtype=dtype), True)
+
+        matfile = h5py.File(filename, 'r')
         
         # Make sure the file has the required fields
         fields = ['func', 'param1', 'param2', 'param1name', 'param2name', 'pixels', 'r', 'format']
@@ -48,8 +163,6 @@ class GreensFunction:
             raise ValueError("Unrecognized Green's function format: "+frmt)
 
         self.NPIXELS = int(matfile['pixels'][0,0])
-        self.FUNC = matfile['func'][:,:]
-        #self.FUNC = matfile['func']
 
         # Generate phase-space
         p1 = matfile['param1']
@@ -59,20 +172,377 @@ class GreensFunction:
         ppar, pperp = self.toPparPperp(p1, p2, p1name, p2name)
 
         tr = matfile['r'][:,0]
-        self.nr = tr.size
-        n = self.nr * ppar.size
+        nmom = ppar.size
+        npixels2 = self.NPIXELS*self.NPIXELS
+        dset = matfile['func']
+
+        if dset.size != tr.size*nmom*npixels2:
+            raise ValueError("Badly formatted Green's function. Expected "+str(tr.size*nmom*npixels2)+" elements in 'func', found "+str(dset.size)+".")
+
+        if radialRange is None:
+            radialRange = (0, tr.size)
+        ir0, ir1 = radialRange
+        if ir0 < 0 or ir1 > tr.size or ir0 >= ir1:
+            raise ValueError("Invalid radial range ("+str(ir0)+", "+str(ir1)+") for Green's function with "+str(tr.size)+" radial points.")
+
+        # The momentum grid is stored in the order of the
+        # transposed meshgrid, as in the Green's function
+        self.phaseSpace = PhaseSpace(tr[ir0:ir1], ppar.T, pperp.T, allocate=allocate)
+
+        # Range of phase-space points (columns) to load
+        self.loadMatrix(filename, dset, ir0*nmom, ir1*nmom, npixels2, loadmode, allocate)
+
+    def loadCache(self, filename, loadmode='memory', radialRange=None, allocate=None, verify=False):
+        """
+        Loads the precompiled Green's function cache with the
+        given name (see 'saveCache()'). The cache stores the
+        grids and matrix in their final layout, so that no
+        conversion is needed and the matrix can be
+        memory-mapped directly.
+
+        filename:    Name of the cache file to load.
+        loadmode:    How to load the Green's function matrix
+                     (see the constructor).
+        radialRange: Range of radial points to load
+                     (see the constructor).
+        allocate:    Array allocation function (see the constructor).
+        verify:      If True, verify the checksums of the loaded
+                     part of the matrix.
+        """
+        if allocate is None:
+            allocate = lambda key, shape, dtype: (np.empty(shape, dtype=dtype), True)
+
+        header, r, momentum, dset = GreensFunction.openCache(filename)
+
+        self.NPIXELS = header['npixels']
+        nr, nmom = header['nr'], header['nmomentum']
+        npixels2 = self.NPIXELS*self.NPIXELS
+
+        if radialRange is None:
+            radialRange = (0, nr)
+        ir0, ir1 = radialRange
+        if ir0 < 0 or ir1 > nr or ir0 >= ir1:
+            raise ValueError("Invalid radial range ("+str(ir0)+", "+str(ir1)+") for Green's function with "+str(nr)+" radial points.")
+
+        if verify:
+            GreensFunction.verifyCache(filename, header, dset, ir0, ir1)
+
+        self.phaseSpace = PhaseSpace(r[ir0:ir1], None, None, momentum=momentum)
+        self.loadMatrix(filename, dset, ir0*nmom, ir1*nmom, npixels2, loadmode, allocate)
+
+    def loadMatrix(self, filename, dset, i0, i1, npixels2, loadmode, allocate):
+        """
+        Load the Green's function matrix for the phase-space
+        points i0 <= i < i1 from the given dataset, as
+        specified by 'loadmode'.
+
+        filename: Name of the Green's function file.
+        dset:     HDF5 dataset (or memory-mapped cache array)
+                  containing the Green's function.
+        i0, i1:   Range of phase-space points to load.
+        npixels2: Number of pixels in the image.
+        loadmode: How to load the matrix (see the constructor).
+        allocate: Array allocation function (see the constructor).
+        """
+        # (the matrix is converted while it is read, if
+        # another data type than that of the file is requested)
+        dtype = dset.dtype if self.dtype is None else np.dtype(self.dtype)
+        key = 'func:'+os.path.abspath(filename)+':'+str(i0)+':'+str(i1)+':'+loadmode+':'+dtype.str
+
+        # Only load the pixels in the pixel mask (if any)
+        rows = None
+        if self.loadMask is not None:
+            rows = np.flatnonzero(np.reshape(np.asarray(self.loadMask), (npixels2,)))
+            key += ':mask:'+str(zlib.crc32(rows.astype(np.int64).tobytes()))
+            self.pixelMask = rows
+
+        self.matrixKey = key
+
+        if loadmode == 'chunked':
+            self.FUNC = self.loadChunked(dset, i0, i1, npixels2, allocate, key, dtype, rows)
+        elif loadmode == 'stream':
+            dataset = None if isinstance(dset, np.memmap) else dset.name
+            self.FUNC = StreamedFunction(filename, dataset, i0, i1, npixels2, dtype, budget=self.budget, rows=rows)
+        elif loadmode == 'mmap' and rows is None:
+            if isinstance(dset, np.memmap):
+                self.FUNC = dset[i0:i1,:].T
+            else:
+                self.FUNC = self.loadMemoryMapped(filename, dset, i0, i1, npixels2)
+
+            # (a memory-mapped matrix can only be
+            # converted by reading it into memory)
+            if self.FUNC.dtype != dtype:
+                self.FUNC = self.FUNC.astype(dtype)
+        else:
+            FUNC, fill = allocate(key, (i1-i0, npixels2 if rows is None else rows.size), dtype)
+            if fill and rows is None:
+                self.readPhaseSpaceRows(dset, i0, i1, npixels2, out=FUNC)
+            elif fill:
+                # (read in blocks, keeping the masked pixels)
+                step = max(1, CHUNK_SIZE // (npixels2*dset.dtype.itemsize))
+                for j0 in range(i0, i1, step):
+                    j1 = min(i1, j0+step)
+                    FUNC[(j0-i0):(j1-i0)] = self.readPhaseSpaceRows(dset, j0, j1, npixels2)[:,rows]
+
+            self.FUNC = FUNC.T
+
+    @staticmethod
+    def isCache(filename):
+        """
+        Returns True if the file with the given name is a
+        precompiled Green's function cache.
+        """
+        with open(filename, 'rb') as f:
+            return (f.read(len(CACHE_MAGIC)) == CACHE_MAGIC)
+
+    @staticmethod
+    def openCache(filename):
+        """
+        Open the precompiled Green's function cache with the
+        given name, verifying its version and the checksums of
+        its header and grids.
+
+        The file consists of a 24 byte prefix (magic, version,
+        header length and header checksum), a JSON header and
+        the arrays, each aligned to CACHE_ALIGNMENT bytes.
+
+        RETURNS a tuple (header, r, momentum, func), where the
+        arrays are memory-mapped from the file: 'r' is the radial
+        grid, 'momentum' the (6, nmomentum) block of momentum
+        quantities (see 'PhaseSpace') and 'func' the
+        (phase-space x pixels) matrix.
+        """
+        with open(filename, 'rb') as f:
+            magic, version, length, crc = struct.unpack('<8sIII', f.read(20))
+            if magic != CACHE_MAGIC:
+                raise ValueError("'"+filename+"' is not a Green's function cache.")
+            if version != CACHE_VERSION:
+                raise ValueError("Unsupported version "+str(version)+" of the Green's function cache '"+filename+"' (expected version "+str(CACHE_VERSION)+"). Regenerate the cache using 'helpers/mkcache.py'.")
 
-        self.FUNC = np.reshape(self.FUNC, (n, self.NPIXELS*self.NPIXELS)).T
+            f.seek(24)
+            text = f.read(length)
 
-        self.smallR = tr
-        self.R = np.matlib.repmat(tr, 1, ppar.size)
-        self.PPAR  = np.reshape((np.matlib.repmat(ppar,  1, self.nr)).T, (1, n))
-        self.PPERP = np.reshape((np.matlib.repmat(pperp, 1, self.nr)).T, (1, n))
+        if len(text) != length or zlib.crc32(text) != crc:
+            raise ValueError("The header of the Green's function cache '"+filename+"' is corrupt.")
 
-        self.P2    = self.PPAR**2 + self.PPERP**2
-        self.P     = np.sqrt(self.P2)
-        self.GAMMA = np.sqrt(1.0 + self.P2)
-        self.XI    = self.PPAR / self.P
+        header = json.loads(text.decode('utf-8'))
+        if os.path.getsize(filename) != header['size']:
+            raise ValueError("The Green's function cache '"+filename+"' has been truncated.")
+
+        nr, nmom, npixels2 = header['nr'], header['nmomentum'], header['npixels']**2
+        offsets = header['offsets']
+
+        r = np.memmap(filename, dtype=np.float64, mode='r', offset=offsets['r'], shape=(nr,))
+        momentum = np.memmap(filename, dtype=np.float64, mode='r', offset=offsets['momentum'], shape=(6, nmom))
+        if zlib.crc32(momentum, zlib.crc32(r)) != header['gridcrc']:
+            raise ValueError("The grids of the Green's function cache '"+filename+"' are corrupt.")
+
+        func = np.memmap(filename, dtype=np.dtype(header['dtype']), mode='r', offset=offsets['func'], shape=(nr*nmom, npixels2))
+
+        return header, r, momentum, func
+
+    @staticmethod
+    def verifyCache(filename, header, func, ir0, ir1):
+        """
+        Verify the checksums of the radial points ir0 <= i < ir1
+        of the matrix in the Green's function cache 'filename'.
+
+        header:   Header of the cache (see 'openCache()').
+        func:     Matrix of the cache (see 'openCache()').
+        ir0, ir1: Range of radial points to verify.
+        """
+        nmom = header['nmomentum']
+        crcs = np.memmap(filename, dtype='<u4', mode='r', offset=header['offsets']['crc'], shape=(header['nr'],))
+
+        for i in range(ir0, ir1):
+            if zlib.crc32(func[(i*nmom):((i+1)*nmom)]) != crcs[i]:
+                raise ValueError("The Green's function cache '"+filename+"' is corrupt (radial point "+str(i)+").")
+
+    def saveCache(self, filename, source=None):
+        """
+        Save this Green's function as a precompiled cache, which
+        can be loaded (and memory-mapped) without any conversion.
+        Each radial point of the matrix is checksummed separately,
+        so that processes only need to verify their own part.
+
+        filename: Name of the cache file to write.
+        source:   Optional dict of information about the source
+                  of the Green's function, stored in the header.
+        """
+        if not isinstance(self.FUNC, np.ndarray) or self.pixelMask is not None or self.diagnostics is not None:
+            raise ValueError("Only uncompressed Green's functions of a single diagnostic without a pixel mask can be saved as a cache.")
+
+        npixels2, n = self.FUNC.shape
+        nr, nmom = self.phaseSpace.getShape()
+
+        r = np.ascontiguousarray(self.getSmallR(), dtype=np.float64)
+        momentum = np.ascontiguousarray(self.phaseSpace.getMomentumBlock(), dtype=np.float64)
+        dtype = self.FUNC.dtype.newbyteorder('<')
+
+        align = lambda x: -(-x // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+        sizes = [('r', r.nbytes), ('momentum', momentum.nbytes), ('func', n*npixels2*dtype.itemsize), ('crc', nr*4)]
+
+        # The array offsets depend on the length of the header,
+        # which in turn depends on the offsets
+        header = {
+            'npixels': self.NPIXELS, 'nr': nr, 'nmomentum': nmom, 'dtype': dtype.str,
+            'gridcrc': zlib.crc32(momentum, zlib.crc32(r)), 'source': source,
+            'offsets': {k: 0 for k, _ in sizes}, 'size': 0
+        }
+        start = 0
+        while True:
+            text = json.dumps(header).encode('utf-8')
+            offset = align(24 + len(text))
+            if offset == start:
+                break
+
+            start = offset
+            for k, size in sizes:
+                header['offsets'][k] = offset
+                offset = align(offset + size)
+
+            header['size'] = header['offsets']['crc'] + nr*4
+
+        crcs = np.zeros((nr,), dtype='<u4')
+        with open(filename, 'wb') as f:
+            f.write(struct.pack('<8sIII', CACHE_MAGIC, CACHE_VERSION, len(text), zlib.crc32(text)))
+            f.seek(24)
+            f.write(text)
+
+            f.seek(header['offsets']['r'])
+            f.write(r.tobytes())
+            f.seek(header['offsets']['momentum'])
+            f.write(momentum.tobytes())
+
+            # Write the matrix as (phase-space x pixels),
+            # one radial point at a time
+            f.seek(header['offsets']['func'])
+            for i in range(0, nr):
+                block = np.ascontiguousarray(self.FUNC[:,(i*nmom):((i+1)*nmom)].T, dtype=dtype)
+                crcs[i] = zlib.crc32(block)
+                f.write(block.tobytes())
+
+            f.seek(header['offsets']['crc'])
+            f.write(crcs.tobytes())
+
+    def loadChunked(self, dset, i0, i1, npixels2, allocate=None, key=None, dtype=None, rows=None):
+        """
+        Read the Green's function matrix in blocks of at
+        most CHUNK_SIZE bytes and store it as a C-contiguous
+        (pixels x phase-space) array. Only one block is
+        held in memory in addition to the final array.
+
+        dset:     HDF5 dataset containing the Green's function.
+        i0, i1:   Range of phase-space points to load.
+        npixels2: Number of pixels in the image.
+        allocate: Array allocation function (see the constructor).
+        key:      Key identifying the array to 'allocate'.
+        dtype:    Data type to store the matrix in (by default,
+                  that of the dataset).
+        rows:     Indices of the pixels to keep (or None for all).
+        """
+        if dtype is None:
+            dtype = dset.dtype
+
+        shape = (npixels2 if rows is None else rows.size, i1-i0)
+        if allocate is None:
+            FUNC, fill = np.empty(shape, dtype=dtype), True
+        else:
+            FUNC, fill = allocate(key, shape, dtype)
+
+        if not fill:
+            return FUNC
+
+        nrows = max(1, CHUNK_SIZE // (npixels2*dset.dtype.itemsize))
+
+        for j0 in range(i0, i1, nrows):
+            j1 = min(i1, j0+nrows)
+            block = self.readPhaseSpaceRows(dset, j0, j1, npixels2)
+            FUNC[:,(j0-i0):(j1-i0)] = (block if rows is None else block[:,rows]).T
+
+        return FUNC
+
+    def loadMemoryMapped(self, filename, dset, i0, i1, npixels2):
+        """
+        Memory-map the Green's function matrix directly from
+        the file. This requires the dataset to be stored
+        contiguously (i.e. neither chunked nor compressed).
+        The returned array is a (pixels x phase-space) view
+        of the on-disk (phase-space x pixels) matrix, which
+        np.matmul consumes without making a copy.
+
+        filename: Name of the Green's function file.
+        dset:     HDF5 dataset containing the Green's function.
+        i0, i1:   Range of phase-space points to map.
+        npixels2: Number of pixels in the image.
+        """
+        offset = dset.id.get_offset()
+        if offset is None or dset.chunks is not None:
+            raise ValueError("The Green's function in '"+filename+"' is not stored contiguously and can not be memory-mapped.")
+
+        offset += i0*npixels2*dset.dtype.itemsize
+        mm = np.memmap(filename, dtype=dset.dtype, mode='r', offset=offset, shape=(i1-i0, npixels2))
+        return mm.T
+
+    @staticmethod
+    def countNonzeros(dset, i0, i1, npixels2):
+        """
+        Count the number of non-zero elements of the Green's
+        function for each of the phase-space points i0 <= i < i1,
+        reading at most CHUNK_SIZE bytes at a time.
+
+        dset:     HDF5 dataset containing the Green's function.
+        i0, i1:   Range of phase-space points to count in.
+        npixels2: Number of pixels in the image.
+        """
+        nnz = np.zeros((i1-i0,), dtype=np.int64)
+        nrows = max(1, CHUNK_SIZE // (npixels2*dset.dtype.itemsize))
+
+        for j0 in range(i0, i1, nrows):
+            j1 = min(i1, j0+nrows)
+            nnz[(j0-i0):(j1-i0)] = np.count_nonzero(GreensFunction.readPhaseSpaceRows(dset, j0, j1, npixels2), axis=1)
+
+        return nnz
+
+    @staticmethod
+    def readPhaseSpaceRows(dset, i0, i1, npixels2, out=None):
+        """
+        Read the Green's function for the phase-space
+        points i0 <= i < i1, returning them as a
+        (i1-i0) x npixels2 array. The dataset may have any
+        2D shape, as long as its C-ordered elements run
+        over pixels fastest.
+
+        dset:     HDF5 dataset (or memory-mapped cache array)
+                  containing the Green's function.
+        i0, i1:   Range of phase-space points to read.
+        npixels2: Number of pixels in the image.
+        out:      Optional (C-contiguous) array to read into.
+        """
+        if dset.shape[1] == npixels2:
+            if out is None:
+                return dset[i0:i1,:]
+            elif isinstance(dset, np.ndarray):
+                out[:] = dset[i0:i1,:]
+                return out
+            else:
+                dset.read_direct(out, source_sel=np.s_[i0:i1,:])
+                return out
+
+        # Read the rows of the dataset covering the
+        # requested range and cut out the relevant part
+        ncols = dset.shape[1]
+        start, end = i0*npixels2, i1*npixels2
+        r0, r1 = start // ncols, -(-end // ncols)
+        data = np.reshape(dset[r0:r1,:], ((r1-r0)*ncols,))
+
+        data = np.reshape(data[(start-r0*ncols):(end-r0*ncols)], (i1-i0, npixels2))
+
+        if out is None:
+            return data
+        else:
+            out[:] = data
+            return out
 
     def toPparPperp(self, p1, p2, p1name, p2name):
         """
@@ -105,11 +575,762 @@ class GreensFunction:
         return ppar, pperp
 
     def getFunction(self): return self.FUNC
-    def getNR(self): return self.nr
+    def getImageSize(self): return self.FUNC.shape[0]
+    def getNR(self): return self.phaseSpace.getNR()
     def getNpixels(self): return self.NPIXELS
-    def getPhaseSpace(self): return self.R, self.PPAR, self.PPERP
-    def getRadialBounds(self): return np.amin(self.smallR), np.amax(self.smallR)
-    def getSmallR(self): return self.smallR
+    def getPhaseSpace(self): return self.phaseSpace
+    def getRadialBounds(self): return np.amin(self.getSmallR()), np.amax(self.getSmallR())
+    def getSmallR(self): return self.phaseSpace.getSmallR()
+
+    def compress(self, rank=None, tolerance=None):
+        """
+        Replace the matrix of this Green's function with a
+        low-rank approximation (see 'LowRankFunction'). Either
+        the rank of the approximation or the largest acceptable
+        relative error must be given.
+
+        rank:      Rank of the approximation.
+        tolerance: Largest acceptable relative (Frobenius norm) error.
+
+        RETURNS the LowRankFunction which replaced the matrix.
+        """
+        self.FUNC = LowRankFunction.compress(self.FUNC, rank=rank, tolerance=tolerance)
+        return self.FUNC
+
+    def getImageShape(self):
+        """
+        Returns the shape of the images computed by 'multiply()'.
+        If a pixel mask has been set, only the pixels in the mask
+        are computed, and images are returned as vectors. The
+        same holds if several diagnostics have been stacked (see
+        'stack()'), in which case the vector contains the pixels
+        of all diagnostics, one after another.
+        """
+        if self.diagnostics is not None:
+            return (self.FUNC.shape[0],)
+        elif self.pixelMask is None:
+            return (self.NPIXELS, self.NPIXELS)
+        else:
+            return (self.pixelMask.size,)
+
+    def setPixelMask(self, mask):
+        """
+        Only compute the pixels for which 'mask' is non-zero
+        (e.g. the pixels in the camera's field of view). The
+        rows of the matrix corresponding to all other pixels
+        are discarded. The remaining rows are copied into a new
+        array, so that the matrix is neither memory-mapped nor
+        shared between processes afterwards; to only load the
+        masked rows in the first place, pass the mask to the
+        constructor instead.
+
+        mask: Array of shape (npixels, npixels).
+        """
+        mask = np.reshape(np.asarray(mask), (self.NPIXELS*self.NPIXELS,))
+        self.pixelMask = np.flatnonzero(mask)
+        self.FUNC = self.FUNC[self.pixelMask,:]
+
+    @staticmethod
+    def stack(greens, allocate=None):
+        """
+        Combine the Green's functions of several diagnostics (e.g.
+        cameras or spectral channels), defined on the same phase-space
+        grid, into one Green's function whose matrix consists of their
+        matrices stacked on top of each other. A single product with
+        the distribution function then computes the images of all
+        diagnostics. Pixel masks must be set before stacking, while
+        compression, pruning etc. should be applied afterwards.
+
+        The matrices are copied into a new array, so a stacked
+        matrix is always held in memory (also if the matrices were
+        memory-mapped), and the matrices and their stacked copy are
+        held in memory at the same time while stacking.
+
+        greens:   List of Green's functions to stack (with dense matrices).
+        allocate: Function allocate(key, shape, dtype) used to allocate
+                  the stacked matrix (see the constructor). If it
+                  shares the matrix between processes, it may only be
+                  read after 'SMPI.synchronizeShared()' has been called.
+                  If None, the matrix is allocated locally.
+
+        RETURNS the stacked Green's function.
+        """
+        first = greens[0]
+        for g in greens[1:]:
+            if g.phaseSpace.getShape() != first.phaseSpace.getShape() or \
+               not np.allclose(g.getSmallR(), first.getSmallR(), rtol=1e-10, atol=0) or \
+               not np.allclose(g.phaseSpace.getMomentumBlock(), first.phaseSpace.getMomentumBlock(), rtol=1e-10, atol=0):
+                raise ValueError("The Green's functions of all diagnostics must be given on the same phase-space grid.")
+
+        for g in greens:
+            if not isinstance(g.FUNC, np.ndarray):
+                raise ValueError("Only uncompressed Green's functions which are loaded into memory can be stacked.")
+
+        rows = [g.getImageSize() for g in greens]
+        offsets = np.concatenate(([0], np.cumsum(rows))).astype(np.int64)
+
+        dtype = np.result_type(*[g.FUNC.dtype for g in greens])
+        shape = (int(offsets[-1]), first.FUNC.shape[1])
+        key = 'stack:'+'|'.join([g.matrixKey for g in greens])+':'+dtype.str
+        if allocate is None:
+            allocate = lambda key, shape, dtype: (np.empty(shape, dtype=dtype), True)
+
+        # (keep the memory layout of the first matrix; a column-major
+        # matrix is allocated as the transpose of a row-major one)
+        if first.FUNC.flags['F_CONTIGUOUS'] and not first.FUNC.flags['C_CONTIGUOUS']:
+            FUNC, fill = allocate(key, shape[::-1], dtype)
+            FUNC = FUNC.T
+        else:
+            FUNC, fill = allocate(key, shape, dtype)
+
+        if fill:
+            for g, o0, o1 in zip(greens, offsets[:-1], offsets[1:]):
+                FUNC[o0:o1,:] = g.FUNC
+
+        gf = copy.copy(first)
+        gf.FUNC = FUNC
+        gf.matrixKey = key
+        gf.pixelMask = None
+        gf.diagnostics = [(g.NPIXELS, g.pixelMask) for g in greens]
+        gf.diagnosticOffsets = offsets
+        gf.workspace = None
+        gf.resetIncremental()
+
+        return gf
+
+    def getNumberOfDiagnostics(self):
+        """
+        Returns the number of diagnostics whose images are
+        computed by this Green's function (see 'stack()').
+        """
+        return 1 if self.diagnostics is None else len(self.diagnostics)
+
+    def splitImage(self, I):
+        """
+        Split image(s), as returned by 'multiply()' (or the
+        output of 'maskImage()'), into a list with the image(s)
+        of each diagnostic (see 'stack()').
+
+        I: Image(s) returned by 'multiply()' or 'multiplyBatch()'.
+        """
+        if self.diagnostics is None:
+            return [I]
+
+        o = self.diagnosticOffsets
+        return [I[...,o[k]:o[k+1]] for k in range(0, len(self.diagnostics))]
+
+    def setIncremental(self, refresh=100):
+        """
+        Enable incremental updates of the image in 'multiply()'.
+        The distribution function, its parameters and the image
+        of the previous call are kept, and on the next call only
+        the columns of the radial points whose parameters have
+        changed are multiplied, and added to the previous image.
+
+        refresh: Number of incremental updates after which the
+                 image is recomputed from scratch (so that round-off
+                 errors do not accumulate). If None, incremental
+                 updates are disabled.
+        """
+        self.refresh = refresh
+        self.resetIncremental()
+
+    def resetIncremental(self):
+        """
+        Forget the state kept for incremental updates.
+        """
+        self.lastParameters = None
+        self.lastF = None
+        self.lastImage = None
+        self.updates = 0
+
+    def setBlocking(self, blockSize=4096, threads=1):
+        """
+        Evaluate the distribution function in blocks of radial
+        points in 'multiply()', multiplying each block with the
+        corresponding columns of the Green's function right away.
+        The full distribution function (and the temporaries of its
+        evaluation) is then never formed, and the block stays in
+        cache while it is multiplied.
+
+        blockSize: Number of phase-space points per block (rounded
+                   to a whole number of radial points, with at least
+                   one radial point per block). If None, blocking
+                   is disabled.
+        threads:   Number of threads to process the blocks with.
+                   Each thread accumulates its own image.
+        """
+        self.blockSize = blockSize
+        self.threads = max(1, threads)
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def setPrecision(self, precision):
+        """
+        Set the precision in which this Green's function is stored
+        and multiplied with. The matrix is converted if necessary.
+
+        precision: One of
+                   'double': Store and compute everything in
+                             double precision (default).
+                   'single': Store the matrix and the momentum
+                             grid, and evaluate the distribution
+                             function, in single precision, so that
+                             all products are done in single precision.
+                   'mixed':  Store the matrix in single precision,
+                             but evaluate the distribution function
+                             in double precision. The distribution
+                             function is converted to single precision
+                             one block at a time (see 'setBlocking()'),
+                             and the products of the blocks are
+                             accumulated in double precision.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("Unrecognized precision: '"+precision+"'.")
+
+        self.precision = precision
+        self.evalDtype = np.float32 if precision == 'single' else np.float64
+        self.workspace = None
+        self.resetIncremental()
+
+        if precision == 'double':
+            return
+
+        if self.FUNC.dtype != np.float32:
+            self.FUNC = self.FUNC.astype(np.float32)
+
+        if precision == 'single':
+            self.phaseSpace = self.phaseSpace.astype(np.float32)
+        elif self.blockSize is None:
+            self.setBlocking()
+
+    def setPruning(self, tolerance):
+        """
+        Only multiply the columns of the matrix which contribute
+        significantly to the image in 'multiply()'. The columns
+        are ranked by |f_j| * ||G_j||_1, where ||G_j||_1 is the
+        (precomputed) L1 norm of column j, and the columns with the
+        smallest contributions are discarded for as long as their
+        sum stays below 'tolerance' times the sum over all columns.
+        By the triangle inequality, the L1 norm of the error in the
+        image is then at most 'tolerance' times the sum over all
+        columns (which is the L1 norm of the image if both the
+        matrix and the distribution function are non-negative).
+
+        The column norms are computed from the current matrix, so
+        pruning should be enabled after the matrix has been masked,
+        compressed or converted.
+
+        tolerance: Largest relative error allowed. If None (or
+                   zero), pruning is disabled.
+        """
+        if not tolerance:
+            self.pruning = None
+            self.columnNorms = None
+        else:
+            self.pruning = tolerance
+            self.columnNorms = self.getColumnNorms()
+
+        self.pruningError = 0.0
+
+    def getColumnNorms(self):
+        """
+        Returns the L1 norms of the columns of the matrix. The
+        matrix is processed one block of columns at a time, to
+        limit the amount of memory needed.
+        """
+        npixels2, n = self.FUNC.shape
+        ncols = max(1, CHUNK_SIZE // (max(1, npixels2)*8))
+
+        norms = np.empty((n,))
+        for j0 in range(0, n, ncols):
+            j1 = min(n, j0+ncols)
+            cols = self.FUNC[:,j0:j1]
+            if scipy.sparse.issparse(cols):
+                norms[j0:j1] = np.ravel(abs(cols).sum(axis=0))
+            else:
+                norms[j0:j1] = np.sum(np.abs(np.asarray(cols, dtype=np.float64)), axis=0)
+
+        return norms
+
+    def getPruningError(self):
+        """
+        Returns the bound on the relative (L1 norm) error of the
+        image computed in the last call to 'multiply()' caused by
+        pruning columns of the matrix (see 'setPruning()').
+        """
+        return self.pruningError
+
+    def castVector(self, x):
+        """
+        Convert the array 'x' to the data type of the matrix
+        (if necessary), so that products with the matrix are
+        done in the precision of the matrix.
+        """
+        return np.asarray(x).astype(self.FUNC.dtype, copy=False)
+
+    def maskImage(self, I):
+        """
+        Returns the pixels of the image (or images) 'I' which
+        are computed by this Green's function, in the same format
+        as the images returned by 'multiply()'.
+
+        I: Image(s), of shape (..., npixels, npixels). If several
+           diagnostics have been stacked (see 'stack()'), a list
+           with the image(s) of each diagnostic.
+        """
+        if self.diagnostics is not None:
+            return np.concatenate([
+                GreensFunction.selectPixels(Ik, npixels, mask)
+                for Ik, (npixels, mask) in zip(I, self.diagnostics)
+            ], axis=-1)
+        elif self.pixelMask is None:
+            return I
+
+        return GreensFunction.selectPixels(I, self.NPIXELS, self.pixelMask)
+
+    @staticmethod
+    def selectPixels(I, npixels, mask):
+        """
+        Returns the pixels of the image(s) I in the pixel mask
+        'mask' (or all pixels, if 'mask' is None) as vector(s).
+
+        I:       Image(s), of shape (..., npixels, npixels).
+        npixels: Number of pixels along each side of the image.
+        mask:    Indices of the pixels to return (or None).
+        """
+        I = np.reshape(I, np.shape(I)[:-2] + (npixels*npixels,))
+        return I if mask is None else I[...,mask]
+
+    @staticmethod
+    def expandPixels(I, npixels, mask):
+        """
+        Inverse of 'selectPixels()': returns image(s) of shape
+        (..., npixels, npixels), with the pixels outside of the
+        pixel mask set to zero.
+        """
+        if mask is None:
+            return np.reshape(I, I.shape[:-1] + (npixels, npixels))
+
+        image = np.zeros(I.shape[:-1] + (npixels*npixels,), dtype=I.dtype)
+        image[...,mask] = I
+
+        return np.reshape(image, I.shape[:-1] + (npixels, npixels))
+
+    def toImage(self, I):
+        """
+        Convert image(s), as returned by 'multiply()', into
+        image(s) of shape (..., npixels, npixels). Pixels
+        outside of the pixel mask are set to zero.
+
+        I: Image(s) returned by 'multiply()' or 'multiplyBatch()'.
+
+        RETURNS the image(s) or, if several diagnostics have been
+        stacked (see 'stack()'), a list with the image(s) of each
+        diagnostic.
+        """
+        if self.diagnostics is not None:
+            return [
+                GreensFunction.expandPixels(Ik, npixels, mask)
+                for Ik, (npixels, mask) in zip(self.splitImage(I), self.diagnostics)
+            ]
+        elif self.pixelMask is None:
+            return I
+
+        return GreensFunction.expandPixels(I, self.NPIXELS, self.pixelMask)
+
+    def sparsify(self, density=None):
+        """
+        Store the matrix of this Green's function in compressed
+        sparse column format. The matrix is converted one block
+        of columns at a time, to limit the amount of memory needed.
+
+        density: If not None, the matrix is only converted if the
+                 fraction of non-zero elements is at most 'density'.
+
+        RETURNS True if the matrix was converted.
+        """
+        npixels2, n = self.FUNC.shape
+        ncols = max(1, CHUNK_SIZE // (max(1, npixels2)*self.FUNC.itemsize))
+
+        if density is not None:
+            nnz = 0
+            for j0 in range(0, n, ncols):
+                nnz += np.count_nonzero(self.FUNC[:,j0:(j0+ncols)])
+
+            if nnz > density*npixels2*n:
+                return False
+
+        blocks = [scipy.sparse.csc_matrix(self.FUNC[:,j0:(j0+ncols)]) for j0 in range(0, n, ncols)]
+        self.FUNC = scipy.sparse.hstack(blocks, format='csc')
+
+        return True
+
+    def evalDistribution(self, distributionFunction, v, out=None):
+        """
+        Evaluate the distribution function specified by the vector
+        'v' on the phase-space grid of this Green's function.
+        Returns an array of shape (nr, nmomentum), with radius
+        varying slowest, just like the columns of FUNC.
+
+        distributionFunction: Distribution function to evaluate.
+        v:                    Vector of parameters specifying shape
+                              of distribution function.
+        out:                  Array to store the result in. If None,
+                              the workspace of this Green's function
+                              is used (see 'getWorkspace()').
+        """
+        r, ppar, pperp = self.phaseSpace.getCoordinates()
+        gamma, p, p2, xi = self.phaseSpace.getMomentumQuantities()
+
+        if out is None:
+            out = self.getWorkspace()
+
+        return distributionFunction.Eval(r, ppar, pperp, v, gamma=gamma, p2=p2, p=p, xi=xi, out=out)
+
+    def getWorkspace(self):
+        """
+        Returns the (nr, nmomentum) buffer which distribution
+        functions are evaluated into. The buffer is allocated
+        on the first call and re-used on subsequent calls.
+        """
+        shape = self.phaseSpace.getShape()
+        if self.workspace is None or self.workspace.shape != shape:
+            self.workspace = np.empty(shape, dtype=self.evalDtype)
+
+        return self.workspace
+
+    def getRadialSlice(self, i0, i1):
+        """
+        Returns a Green's function consisting of the radial
+        points i0 <= i < i1 of this Green's function. The
+        matrix of the returned Green's function is a view
+        of the matrix of this Green's function.
+
+        i0, i1: Range of radial points to include.
+        """
+        nmom = self.phaseSpace.getNMomentum()
+
+        gf = copy.copy(self)
+        gf.phaseSpace = self.phaseSpace.getRadialSlice(i0, i1)
+        gf.FUNC = self.FUNC[:,(i0*nmom):(i1*nmom)]
+        gf.workspace = None
+        gf.executor = None
+        gf.resetIncremental()
+
+        if self.columnNorms is not None:
+            gf.columnNorms = self.columnNorms[(i0*nmom):(i1*nmom)]
+
+        return gf
+
+    def getTensor(self):
+        """
+        Returns the Green's function as a (pixels, nr, nmomentum)
+        tensor. The tensor is always a view of FUNC, which is
+        never reshaped into a copy.
+        """
+        nr, nmom = self.phaseSpace.getShape()
+        npixels2 = self.FUNC.shape[0]
+
+        if self.FUNC.flags['C_CONTIGUOUS']:
+            return np.reshape(self.FUNC, (npixels2, nr, nmom))
+        elif self.FUNC.flags['F_CONTIGUOUS']:
+            return np.transpose(np.reshape(self.FUNC.T, (nr, nmom, npixels2)), (2, 0, 1))
+        else:
+            return np.lib.stride_tricks.as_strided(
+                self.FUNC, shape=(npixels2, nr, nmom),
+                strides=(self.FUNC.strides[0], nmom*self.FUNC.strides[1], self.FUNC.strides[1]),
+                writeable=False
+            )
+
+    def contract(self, f):
+        """
+        Contract the Green's function tensor with the distribution
+        function f, given in (nr, nmomentum) form. Returns the
+        (flattened) image.
+
+        f: Distribution function (shape (nr, nmomentum)).
+        """
+        nr, nmom = self.phaseSpace.getShape()
+        gf = self.FUNC
+
+        # Low-rank: U(S(Vt f)); sparse: CSC matrix-vector
+        # product; streamed: one product per block read
+        # Mixed precision: accumulate the products of the
+        # blocks of columns in double precision
+        if self.precision == 'mixed' and not isinstance(gf, LowRankFunction):
+            f = np.reshape(f, (nr*nmom,))
+            step = self.blockSize or nmom
+            I = np.zeros((gf.shape[0],))
+            for j0 in range(0, nr*nmom, step):
+                I += gf[:,j0:(j0+step)] @ self.castVector(f[j0:(j0+step)])
+
+            return I
+
+        f = self.castVector(f)
+
+        if isinstance(gf, (LowRankFunction, StreamedFunction)) or scipy.sparse.issparse(gf):
+            return gf @ np.reshape(f, (nr*nmom,))
+        # Row-major (pixels x phase-space): a single matrix-vector product
+        elif gf.flags['C_CONTIGUOUS']:
+            return np.matmul(gf, np.reshape(f, (nr*nmom,)))
+        # Column-major: contract from the phase-space side
+        elif gf.flags['F_CONTIGUOUS']:
+            return np.matmul(np.reshape(f, (nr*nmom,)), gf.T)
+        else:
+            return np.einsum('xrm,rm->x', self.getTensor(), f)
+
+    def contractBatch(self, F):
+        """
+        Contract the Green's function tensor with a batch of
+        distribution functions using a single matrix-matrix
+        product. Returns the (flattened) images as an array of
+        shape (k, pixels).
+
+        F: Distribution functions (shape (k, nr, nmomentum)).
+        """
+        nr, nmom = self.phaseSpace.getShape()
+        gf = self.FUNC
+        F = self.castVector(np.reshape(F, (F.shape[0], nr*nmom)))
+
+        if isinstance(gf, LowRankFunction):
+            return np.matmul(np.matmul(F, gf.Vt.T) * gf.S, gf.U.T)
+        elif isinstance(gf, StreamedFunction) or scipy.sparse.issparse(gf):
+            return np.ascontiguousarray((gf @ F.T).T)
+        elif gf.flags['C_CONTIGUOUS']:
+            return np.matmul(gf, F.T).T
+        elif gf.flags['F_CONTIGUOUS']:
+            return np.matmul(F, gf.T)
+        else:
+            return np.einsum('xrm,krm->kx', self.getTensor(), np.reshape(F, (F.shape[0], nr, nmom)))
+
+    def contractSeparable(self, s, g):
+        """
+        Contract the Green's function tensor with a separable
+        distribution function f(r, p) = s(r) * g(p), without
+        ever forming the full distribution function. Returns
+        the (flattened) image.
+
+        s: Radial amplitude (shape (nr,)).
+        g: Momentum-space shape (shape (nmomentum,)).
+        """
+        nr, nmom = self.phaseSpace.getShape()
+        gf = self.FUNC
+        npixels2 = gf.shape[0]
+
+        # Mixed precision: only the factor multiplied with the
+        # matrix is converted, and the products are accumulated
+        # in double precision in the second contraction (or, if
+        # there is none, block by block by 'contract()')
+        if self.precision == 'mixed':
+            dense = isinstance(gf, np.ndarray) and (gf.flags['C_CONTIGUOUS'] or gf.flags['F_CONTIGUOUS'])
+            if not dense and not isinstance(gf, LowRankFunction):
+                return self.contract(np.outer(s, g))
+
+            cast = lambda x: x
+        else:
+            cast = self.castVector
+
+        # Low-rank: contract the right singular vectors,
+        # viewed as a (rank, nr, nmomentum) tensor
+        if isinstance(gf, LowRankFunction):
+            k = gf.getRank()
+            Ir = np.matmul(np.reshape(gf.Vt, (k*nr, nmom)), self.castVector(g))
+            return np.matmul(gf.U, self.castVector(gf.S * np.matmul(np.reshape(Ir, (k, nr)), cast(s))))
+        elif isinstance(gf, StreamedFunction) or scipy.sparse.issparse(gf):
+            return gf @ self.castVector(np.reshape(np.outer(s, g), (nr*nmom,)))
+        # Row-major: contract momentum first (the innermost,
+        # contiguous index), then radius
+        elif gf.flags['C_CONTIGUOUS']:
+            Ir = np.matmul(np.reshape(gf, (npixels2*nr, nmom)), self.castVector(g))
+            return np.matmul(np.reshape(Ir, (npixels2, nr)), cast(s))
+        # Column-major: pre-contract over radius (the slowest
+        # index of the transposed matrix), then momentum
+        elif gf.flags['F_CONTIGUOUS']:
+            Ip = np.matmul(self.castVector(s), np.reshape(gf.T, (nr, nmom*npixels2)))
+            return np.matmul(cast(g), np.reshape(Ip, (nmom, npixels2)))
+        else:
+            return np.einsum('xrm,r,m->x', self.getTensor(), self.castVector(s), self.castVector(g))
+
+    def contractRadii(self, radii, F):
+        """
+        Contract the columns of the Green's function belonging to
+        the given radial points with the distribution function F,
+        given at those radial points. Each contiguous run of radial
+        points is contracted with one matrix-vector product.
+        Returns the (flattened) image.
+
+        radii: Indices of the radial points (increasing).
+        F:     Distribution function (shape (radii.size, nmomentum)).
+        """
+        nmom = self.phaseSpace.getNMomentum()
+        I = np.zeros((self.FUNC.shape[0],))
+
+        runs = np.split(np.arange(radii.size), np.flatnonzero(np.diff(radii) != 1) + 1)
+        for run in runs:
+            i0, i1 = radii[run[0]], radii[run[-1]]+1
+            I += self.FUNC[:,(i0*nmom):(i1*nmom)] @ self.castVector(np.reshape(F[run], ((i1-i0)*nmom,)))
+
+        return I
+
+    def contractPruned(self, f):
+        """
+        Contract the Green's function tensor with the distribution
+        function f, only multiplying the columns which contribute
+        significantly to the image (see 'setPruning()'). The kept
+        columns are multiplied one contiguous run at a time, with
+        runs separated by at most PRUNE_GAP columns merged (which
+        only reduces the error). Returns the (flattened) image.
+
+        f: Distribution function (shape (nr, nmomentum)).
+        """
+        nr, nmom = self.phaseSpace.getShape()
+        gf = self.FUNC
+        f = np.reshape(f, (nr*nmom,))
+
+        # Discard the columns with the smallest contributions
+        # for as long as their sum stays within the tolerance
+        w = np.abs(f) * self.columnNorms
+        order = np.argsort(w)
+        discarded = np.cumsum(w[order])
+        total = discarded[-1] if discarded.size > 0 else 0.0
+
+        k = np.searchsorted(discarded, self.pruning*total, side='right')
+        keep = np.sort(order[k:])
+        self.pruningError = discarded[k-1]/total if k > 0 and total > 0 else 0.0
+
+        # Low-rank: accumulate in the space of the singular
+        # vectors, and expand to pixels once at the end
+        if isinstance(gf, LowRankFunction):
+            I = np.zeros((gf.getRank(),))
+        else:
+            I = np.zeros((gf.shape[0],))
+
+        if keep.size > 0:
+            breaks = np.flatnonzero(np.diff(keep) > PRUNE_GAP+1)
+            starts = keep[np.concatenate(([0], breaks+1))]
+            ends = keep[np.concatenate((breaks, [keep.size-1]))] + 1
+
+            for j0, j1 in zip(starts, ends):
+                if isinstance(gf, LowRankFunction):
+                    I += gf.Vt[:,j0:j1] @ self.castVector(f[j0:j1])
+                else:
+                    I += gf[:,j0:j1] @ self.castVector(f[j0:j1])
+
+        if isinstance(gf, LowRankFunction):
+            I = gf.U @ self.castVector(gf.S * I)
+
+        return I
+
+    def multiplyIncremental(self, distributionFunction, v):
+        """
+        Multiply this Green's function with the given distribution
+        function, only recomputing the contributions of the radial
+        points whose parameters have changed since the previous call
+        (see 'setIncremental()'). Returns the (flattened) image.
+
+        distributionFunction: Distribution function to evaluate.
+        v:                    Vector of parameters specifying shape
+                              of distribution function.
+        """
+        r, ppar, pperp = self.phaseSpace.getCoordinates()
+        gamma, p, p2, xi = self.phaseSpace.getMomentumQuantities()
+        nr, nmom = self.phaseSpace.getShape()
+
+        V = distributionFunction.GetParameters(v)
+
+        changed = None
+        if self.lastImage is not None and self.updates < self.refresh and V.shape == self.lastParameters.shape:
+            changed = np.flatnonzero(np.any(V != self.lastParameters, axis=(0,2)))
+
+            # Beyond half of the radii, starting over is cheaper
+            if changed.size > nr // 2:
+                changed = None
+
+        if changed is not None and changed.size > 0:
+            f = distributionFunction.EvalParameters(V[:,changed], ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+            self.lastImage += self.contractRadii(changed, f - self.lastF[changed])
+            self.lastF[changed] = f
+            self.updates += 1
+
+        if changed is None:
+            if self.lastF is None:
+                self.lastF = np.empty((nr, nmom), dtype=self.evalDtype)
+
+            self.evalDistribution(distributionFunction, v, out=self.lastF)
+            self.lastImage = self.contract(self.lastF)
+            self.updates = 0
+
+        self.lastParameters = V
+
+        return self.lastImage.copy()
+
+    def multiplyBlocked(self, distributionFunction, v):
+        """
+        Multiply this Green's function with the given distribution
+        function, evaluating the distribution function one block of
+        radial points at a time (see 'setBlocking()'). The blocks
+        are split into one contiguous range per thread. Returns the
+        (flattened) image.
+
+        distributionFunction: Distribution function to evaluate.
+        v:                    Vector of parameters specifying shape
+                              of distribution function.
+        """
+        r, ppar, pperp = self.phaseSpace.getCoordinates()
+        gamma, p, p2, xi = self.phaseSpace.getMomentumQuantities()
+        nr, nmom = self.phaseSpace.getShape()
+
+        V = distributionFunction.GetParameters(v)
+        # (computed here, rather than concurrently by the threads)
+        distributionFunction.GetInvariants(ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+        step = max(1, self.blockSize // nmom)
+        gf = self.FUNC
+
+        def multiplyRange(j0, j1):
+            buf = np.empty((min(step, j1-j0), nmom), dtype=self.evalDtype)
+
+            # Low-rank: accumulate in the space of the singular
+            # vectors, and expand to pixels once at the end
+            if isinstance(gf, LowRankFunction):
+                I = np.zeros((gf.getRank(),))
+            else:
+                I = np.zeros((gf.shape[0],))
+
+            for i0 in range(j0, j1, step):
+                i1 = min(j1, i0+step)
+                f = distributionFunction.EvalParameters(V[:,i0:i1], ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi, out=buf[:(i1-i0)])
+                f = self.castVector(np.reshape(f, ((i1-i0)*nmom,)))
+
+                if isinstance(gf, LowRankFunction):
+                    I += gf.Vt[:,(i0*nmom):(i1*nmom)] @ f
+                else:
+                    I += gf[:,(i0*nmom):(i1*nmom)] @ f
+
+            return I
+
+        # Contiguous ranges of radii, in whole blocks
+        nblocks = -(-nr // step)
+        bounds = [min(nr, step*((t*nblocks) // self.threads)) for t in range(0, self.threads+1)]
+        ranges = [(bounds[t], bounds[t+1]) for t in range(0, self.threads) if bounds[t] < bounds[t+1]]
+
+        if len(ranges) == 1:
+            I = multiplyRange(*ranges[0])
+        else:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+
+            futures = [self.executor.submit(multiplyRange, j0, j1) for j0, j1 in ranges]
+            I = sum(future.result() for future in futures)
+
+        if isinstance(gf, LowRankFunction):
+            I = gf.U @ self.castVector(gf.S * I)
+
+        return I
 
     def multiply(self, distributionFunction, v):
         """
@@ -124,21 +1345,94 @@ class GreensFunction:
                               [a0,a1,...,an,b0,b1,...,bn,c0,c1,...,cn]
                               where each index corresponds to an
                               individual radius.
+
+        RETURNS the image, of the shape given by 'getImageShape()'.
         """
-        gf = self.FUNC
-        r, ppar, pperp = self.getPhaseSpace()
-        npixels = self.NPIXELS
-        npixels2 = npixels*npixels
-        n = r.shape[1]
-        I = np.zeros(npixels2)
-        f = distributionFunction.Eval(r, ppar, pperp, v, gamma=self.GAMMA, p2=self.P2, p=self.P, xi=self.XI)
-        
-        I = np.matmul(gf, f.T)
-        #for i in range(0, n):
-        #    s = gf[(i*npixels2):((i+1)*npixels2)] * f[0,i]
-        #    I += s[:,0]
+        if self.refresh is not None:
+            return np.reshape(self.multiplyIncremental(distributionFunction, v), self.getImageShape())
+
+        r, ppar, pperp = self.phaseSpace.getCoordinates()
+        gamma, p, p2, xi = self.phaseSpace.getMomentumQuantities()
+
+        # If the momentum-space shape is the same at all
+        # radii, avoid forming the full distribution function
+        sep = distributionFunction.EvalSeparable(r, ppar, pperp, v, gamma=gamma, p2=p2, p=p, xi=xi)
+        if sep is not None:
+            I = self.contractSeparable(*sep)
+        elif self.pruning is not None:
+            f = self.evalDistribution(distributionFunction, v)
+            I = self.contractPruned(f)
+        elif self.blockSize is not None:
+            I = self.multiplyBlocked(distributionFunction, v)
+        else:
+            f = self.evalDistribution(distributionFunction, v)
+            I = self.contract(f)
+
+        I = np.reshape(I, self.getImageShape())
+        return I
+
+    def gradient(self, distributionFunction, v, residual):
+        """
+        Compute the gradient, with respect to the input vector 'v',
+        of the inner product of 'residual' with the image generated
+        from 'v' by this Green's function. The gradient is computed
+        adjointly: the residual is back-projected through the
+        Green's function, multiplied by the derivatives of the
+        distribution function with respect to its parameters and
+        pulled back through the radial interpolation.
+
+        distributionFunction: Distribution function generating the image.
+        v:                    Vector of parameters specifying shape
+                              of distribution function.
+        residual:             Image (of the shape given by
+                              'getImageShape()') to take the inner
+                              product with.
+
+        RETURNS a vector of the same length as 'v'.
+        """
+        r, ppar, pperp = self.phaseSpace.getCoordinates()
+        gamma, p, p2, xi = self.phaseSpace.getMomentumQuantities()
+
+        Q = np.reshape(self.castVector(np.reshape(residual, (self.getImageSize(),))) @ self.FUNC, self.phaseSpace.getShape())
+
+        V = distributionFunction.GetParameters(v)
+        G = distributionFunction.EvalParametersGradient(V, Q, ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+        # (the distribution function does not depend on 'v')
+        if G.shape[0] == 0:
+            return np.zeros((np.size(v),))
+
+        return distributionFunction.PreprocessInputVectorAdjoint(G)
+
+    def multiplyBatch(self, distributionFunction, V):
+        """
+        Multiply this Green's function with a batch of
+        distribution functions at once. The distribution
+        functions are evaluated one after another, after which
+        all images are computed in a single matrix-matrix
+        product. Returns an array of shape (k, npixels, npixels)
+        (or (k, pixels in mask) if a pixel mask has been set).
+
+        distributionFunction: Function handle to function
+                              that evaluates the distribution
+                              function to evaluate with.
+        V:                    Array of shape (k, len(v)), with each row
+                              being a vector of parameters specifying
+                              the shape of a distribution function
+                              (see 'multiply()').
+        """
+        nr, nmom = self.phaseSpace.getShape()
+
+        V = np.atleast_2d(V)
+        k = V.shape[0]
+
+        F = np.empty((k, nr, nmom), dtype=self.evalDtype)
+        for i in range(0, k):
+            self.evalDistribution(distributionFunction, V[i], out=F[i])
+
+        I = self.contractBatch(F)
 
-        I = np.reshape(I, (npixels, npixels))
+        I = np.reshape(I, (k,) + self.getImageShape())
         return I
 
 if __name__ == '__main__':
@@ -10,8 +10,10 @@ import SMPI
 import smutil
 import scipy.io
 import h5py
+import numpy as np
 
-from GreensFunction import GreensFunction
+from GramEngine import GramEngine
+from GreensFunction import GreensFunction, LOAD_MODES, PRECISIONS, SPARSE_DENSITY
 from AvalancheDistributionFunction import AvalancheDistributionFunction
 from SemiAvalancheDistributionFunction import SemiAvalancheDistributionFunction
 from UnitDistributionFunction import UnitDistributionFunction
@@ -19,14 +21,35 @@ from UnitDistributionFunction import UnitDistributionFunction
 from SmulException import SmulException
 
 distribution = None
+engine = None
 green = None
 realImage = None
+# Weight of the likeness of each diagnostic
+weights = None
 nr = None
 
 # Global radial min/max
 RMIN = None
 RMAX = None
 
+# Ways of balancing a single Green's function across processes
+BALANCE_MODES = ['columns', 'nonzeros']
+
+# Ways of compressing the Green's function
+#   none    -- Store the Green's function as a dense matrix
+#   lowrank -- Store a truncated SVD of the Green's function
+#              (see 'LowRankFunction')
+#   sparse  -- Store the Green's function as a sparse (CSC) matrix
+#   auto    -- Store the Green's function as a sparse matrix if
+#              its density is below SPARSE_DENSITY
+COMPRESSION_MODES = ['none', 'lowrank', 'sparse', 'auto']
+
+# Ways of computing the likeness
+#   image -- Form the image and compare it to the real image
+#   gram  -- Evaluate the likeness using the pre-computed Gram
+#            matrix of the Green's function (see 'GramEngine')
+ENGINES = ['image', 'gram']
+
 def constructDistributionFunction(name, config, rmin, rmax, greenRadialGrid):
     """
     Construct the distribution function to run with.
@@ -71,21 +94,172 @@ def constructFilelist(basename):
 
     return filelist
             
+def constructPartition(filename, balance='columns'):
+    """
+    Partition the single Green's function file 'filename'
+    across all MPI processes. The Green's function is split
+    along the radial grid into contiguous blocks, so that each
+    process gets (roughly) the same number of phase-space columns
+    or the same number of non-zero elements. This function must
+    be called collectively by all processes.
+
+    filename: Name of the Green's function file.
+    balance:  What to balance between processes; either
+              'columns' or 'nonzeros'.
+
+    RETURNS a list of tuples (i0, i1), one for each process,
+    giving the range of radial points to load.
+    """
+    nproc = SMPI.nproc()
+
+    matfile = None
+    if GreensFunction.isCache(filename):
+        header, r, momentum, dset = GreensFunction.openCache(filename)
+        nr, npixels, nmom = header['nr'], header['npixels'], header['nmomentum']
+    else:
+        matfile = h5py.File(filename, 'r')
+        nr = matfile['r'].size
+        npixels = int(matfile['pixels'][0,0])
+        dset = matfile['func']
+        nmom = dset.size // (nr*npixels*npixels)
+
+    if nr < nproc:
+        smutil.error("Unable to partition Green's function with "+str(nr)+" radial points across "+str(nproc)+" processes.")
+
+    if balance == 'nonzeros':
+        # Each process counts the non-zeros of every nproc'th radius
+        work = np.zeros((nr,), dtype=np.int64)
+        for i in range(SMPI.rank(), nr, nproc):
+            work[i] = np.sum(GreensFunction.countNonzeros(dset, i*nmom, (i+1)*nmom, npixels*npixels))
+
+        work = SMPI.allreduce(work, SMPI.SUM)
+    else:
+        work = np.full((nr,), nmom, dtype=np.int64)
+
+    if matfile is not None:
+        matfile.close()
+
+    return partitionWork(work, nproc)
+
+def partitionWork(work, nparts):
+    """
+    Split the radial grid into 'nparts' contiguous blocks,
+    placing the boundaries where the cumulative amount of
+    work crosses multiples of the average, and making sure
+    that every block gets at least one radius.
+
+    work:   Amount of work for each radial point.
+    nparts: Number of blocks to split the radial grid into.
+
+    RETURNS a list of tuples (i0, i1), one for each block.
+    """
+    nr = len(work)
+    cumwork = np.cumsum(work)
+    targets = cumwork[-1] * np.arange(1, nparts) / nparts
+    bounds = np.searchsorted(cumwork, targets, side='left') + 1
+    bounds = np.concatenate(([0], bounds, [nr]))
+
+    for i in range(1, nparts):
+        bounds[i] = min(max(bounds[i], bounds[i-1]+1), nr-(nparts-i))
+
+    return [(int(bounds[i]), int(bounds[i+1])) for i in range(0, nparts)]
+
+def getBackend(conf, backend=None):
+    """
+    Determine which execution backend to use, as given by
+    the 'backend' option in the configuration file 'conf'.
+    If no backend is specified, MPI is used if mpi4py is
+    available, and the serial backend otherwise. Only the
+    options of the chosen backend are returned.
+
+    conf:    Name of configuration file.
+    backend: Name of backend to use instead of the one
+             given in the configuration file (or None).
+
+    RETURNS the name of the backend and a dict with
+    options to pass to the backend.
+    """
+    config = configparser.ConfigParser()
+    config.read(conf)
+
+    general = config['general'] if 'general' in config else {}
+    options = {}
+
+    if backend is not None:
+        name = backend
+    elif 'backend' in general:
+        name = general['backend']
+    else:
+        try:
+            import mpi4py
+            name = 'mpi'
+        except ImportError:
+            name = 'serial'
+
+    if name == 'multiprocessing' and 'processes' in general:
+        options['processes'] = int(general['processes'])
+    if name == 'mpi' and 'sharednode' in general:
+        options['sharednode'] = config['general'].getboolean('sharednode')
+    if 'replicas' in general:
+        try:
+            replicas = int(general['replicas'])
+        except ValueError:
+            replicas = 0
+
+        if replicas < 1:
+            raise SmulException("Invalid number of replica groups: '"+general['replicas']+"'. Expected a positive integer.")
+        elif name == 'mpi':
+            options['replicas'] = replicas
+        elif replicas > 1:
+            print("WARNING: Replica groups are only supported by the 'mpi' backend. Ignoring 'replicas = "+str(replicas)+"'.")
+
+    return name, options
+
 def getGlobalRBounds():
     global RMIN, RMAX
     return RMIN, RMAX
 
+def getList(value):
+    """
+    Split the comma-separated list 'value' (as given for
+    the options of several diagnostics) into its elements.
+    """
+    return [v.strip() for v in value.split(',')]
+
 def getNR():
     global nr
     return nr
 
-def loadGreensFunction(filename):
+def loadGreensFunction(filename, loadmode='memory', radialRange=None, verify=False, budget=None, dtype=None, mask=None):
     """
-    Load the Green's function with the given name.
-
-    filename: Name of Green's function to load.
+    Load the Green's function with the given name. Arrays
+    which are identical between processes on the same node
+    are shared if the backend supports it.
+
+    filename:    Name of Green's function to load.
+    loadmode:    How to load the Green's function matrix
+                 ('memory', 'chunked', 'mmap' or 'stream').
+    radialRange: Range (i0, i1) of radial points to load
+                 (or None to load all).
+    verify:      Whether to verify the checksums of the matrix
+                 if the file is a precompiled cache.
+    budget:      Memory budget (in bytes) for streaming the
+                 matrix in 'stream' load mode.
+    dtype:       Data type to store the matrix in (or None to
+                 use the data type of the file).
+    mask:        Pixel mask (or None); only the rows of the
+                 matrix for the pixels in the mask are loaded.
     """
-    return GreensFunction(filename)
+    # (abort all processes if the file is corrupt, rather
+    # than leaving them waiting for this process)
+    try:
+        green = GreensFunction(filename, loadmode=loadmode, radialRange=radialRange, allocate=SMPI.allocateShared, verify=verify, budget=budget, dtype=dtype, mask=mask)
+    except ValueError as e:
+        smutil.error(str(e))
+
+    SMPI.synchronizeShared()
+
+    return green
 
 def loadRealImage(filename):
     img = None
@@ -108,7 +282,7 @@ def initialize(conf, inputRealImage=True):
     Initializes this process by reading the configuration
     file with name given by 'conf'.
     """
-    global distribution, green, realImage, RMIN, RMAX
+    global distribution, engine, green, realImage, weights, RMIN, RMAX
 
     print('Obtaining process rank')
     rank = SMPI.rank()
@@ -117,57 +291,177 @@ def initialize(conf, inputRealImage=True):
     print(str(rank)+': Loading configuration file')
     config = loadConfiguration(conf)
 
-    fname = None
-    if rank == 0:
-        bname = config['general']['green']
-        filelist = constructFilelist(bname)
-
-        # Distribute filenames to processes (give 0 to this process)
-        print('Distributing filenames to other processes')
-        n = len(filelist)
-        fname = filelist[0]
-        for i in range(1, n):
-            SMPI.send(filelist[i], i, SMPI.TAG_GREENSFUNCTION_NAME)
-
-        if inputRealImage and os.path.isfile(config['general']['image']):
-            print('Loading real image...')
-            realImage = loadRealImage(config['general']['image'])
+    partition = None
+    greens = getList(config['general']['green'])
+    images = getList(config['general']['image'])
+    masks = getList(config['general']['mask']) if 'mask' in config['general'] else ['']*len(greens)
+
+    # Determine the Green's function file of this process (and
+    # the radial points to load from it) for each diagnostic
+    fnames, radialRanges = [], []
+    for bname in greens:
+        # A single Green's function file is partitioned automatically
+        # across all processes (in the same way for all diagnostics,
+        # as they share the phase-space grid)
+        if '#d' not in bname:
+            if partition is None:
+                print(str(rank)+": Partitioning Green's function")
+                partition = constructPartition(bname, balance=config['general']['balance'])
+
+            fnames.append(bname)
+            radialRanges.append(partition[rank])
+            continue
+
+        if rank == 0:
+            filelist = constructFilelist(bname)
+
+            # Distribute filenames to processes (give 0 to this process)
+            print('Distributing filenames to other processes')
+            n = len(filelist)
+            fnames.append(filelist[0])
+            for i in range(1, n):
+                SMPI.send(filelist[i], i, SMPI.TAG_GREENSFUNCTION_NAME)
         else:
-            print('WARNING: Image to compare to did not exists. Assuming it will not be needed...')
-            realImage = config['general']['image']
-    else:
-        # Get name of greens function
-        fname = SMPI.recv(SMPI.ROOT_PROC, SMPI.TAG_GREENSFUNCTION_NAME)
+            # Get name of greens function
+            fnames.append(SMPI.recv(SMPI.ROOT_PROC, SMPI.TAG_GREENSFUNCTION_NAME))
 
-    dfname = config['general']['distribution']
-    print(str(rank)+": Loading Green's function...")
-    green = loadGreensFunction(fname)
-    rmin, rmax = green.getRadialBounds()
+        radialRanges.append(None)
 
-    # Distribute Green's function radial limits
     if rank == 0:
-        RMIN = rmin
-        RMAX = rmax
-
-        # Get local limits
-        n = SMPI.nproc()
-        for i in range(1, n):
-            mn, mx = SMPI.recv(i, SMPI.TAG_RADIAL_BOUNDS_LOCAL)
-            if mn < RMIN: RMIN = mn
-            if mx > RMAX: RMAX = mx
-
-        # Distribute global limits
-        for i in range(1, n):
-            SMPI.send((RMIN, RMAX), i, SMPI.TAG_RADIAL_BOUNDS_GLOBAL)
+        realImage = []
+        for image in images:
+            if inputRealImage and os.path.isfile(image):
+                print('Loading real image...')
+                realImage.append(loadRealImage(image))
+            else:
+                print('WARNING: Image to compare to did not exists. Assuming it will not be needed...')
+                realImage.append(image)
+
+        if len(realImage) == 1:
+            realImage = realImage[0]
+
+    weights = [float(w) for w in getList(config['general']['weights'])]
+
+    dfname = config['general']['distribution']
+    precision = config['general']['precision']
+    parts = []
+    for fname, radialRange, mask in zip(fnames, radialRanges, masks):
+        # Only load the pixels in the region of interest
+        if mask:
+            print(str(rank)+': Loading pixel mask')
+            mask = loadRealImage(mask)
+
+        print(str(rank)+": Loading Green's function...")
+        part = loadGreensFunction(
+            fname, loadmode=config['general']['loadmode'], radialRange=radialRange,
+            verify=config['general'].getboolean('cacheverify'),
+            budget=int(float(config['general']['budget'])*1024*1024),
+            # (the low-rank approximation is computed in double
+            # precision, and converted afterwards)
+            dtype=np.float32 if precision != 'double' and config['general']['compression'] != 'lowrank' else None,
+            mask=mask if isinstance(mask, np.ndarray) else None
+        )
+
+        parts.append(part)
+
+    # Compute the images of all diagnostics in one product
+    if len(parts) > 1:
+        print(str(rank)+": Stacking Green's functions of "+str(len(parts))+" diagnostics")
+        try:
+            green = GreensFunction.stack(parts, allocate=SMPI.allocateShared)
+        except ValueError as e:
+            smutil.error(str(e))
+
+        SMPI.synchronizeShared()
     else:
-        # Send local limits
-        SMPI.send((rmin, rmax), SMPI.ROOT_PROC, SMPI.TAG_RADIAL_BOUNDS_LOCAL)
-        # Get global limits
-        RMIN, RMAX = SMPI.recv(SMPI.ROOT_PROC, SMPI.TAG_RADIAL_BOUNDS_GLOBAL)
+        green = parts[0]
+
+    parts = None
+    rmin, rmax = green.getRadialBounds()
+
+    compression = config['general']['compression']
+    if compression == 'lowrank':
+        compressGreensFunction(green, config['general'])
+    elif compression == 'sparse':
+        green.sparsify()
+    elif compression == 'auto':
+        if green.sparsify(density=SPARSE_DENSITY):
+            print(str(rank)+": Storing Green's function as a sparse matrix")
+
+    # Determine global Green's function radial limits
+    RMIN = SMPI.allreduce(rmin, SMPI.MIN)
+    RMAX = SMPI.allreduce(rmax, SMPI.MAX)
 
     print(str(rank)+': Constructing distribution function')
     distribution = constructDistributionFunction(dfname, config[dfname], RMIN, RMAX, green.getSmallR())
 
+    if config['general'].getboolean('incremental'):
+        green.setIncremental(refresh=int(config['general']['refresh']))
+    if config['general'].getboolean('blocking'):
+        green.setBlocking(blockSize=int(config['general']['blocksize']), threads=int(config['general']['threads']))
+    if precision != 'double':
+        green.setPrecision(precision)
+    if float(config['general']['pruning']) > 0:
+        print(str(rank)+': Computing column norms for pruning')
+        green.setPruning(float(config['general']['pruning']))
+
+    SMPI.setup(green, distribution)
+
+    if config['general']['engine'] == 'gram':
+        print(str(rank)+': Constructing Gram matrix')
+        engine = constructGramEngine(green, distribution)
+
+def compressGreensFunction(green, config):
+    """
+    Replace the Green's function matrix with a low-rank
+    approximation, of the rank or tolerance given by the
+    'rank' and 'tolerance' options, and report the achieved
+    relative error.
+
+    green:  Green's function of this process.
+    config: General section of the configuration.
+    """
+    rank = int(config['rank']) if 'rank' in config else None
+    tolerance = float(config['tolerance']) if 'tolerance' in config else None
+
+    print(str(SMPI.rank())+": Compressing Green's function")
+    lr = green.compress(rank=rank, tolerance=tolerance)
+
+    # Relative error of the complete Green's function
+    error2 = SMPI.allreduce(lr.error2, SMPI.SUM)
+    norm2 = SMPI.allreduce(lr.norm2, SMPI.SUM)
+    maxrank = SMPI.allreduce(lr.getRank(), SMPI.MAX)
+
+    if SMPI.rank() == SMPI.ROOT_PROC:
+        err = np.sqrt(error2/norm2) if norm2 > 0 else 0.0
+        print("Compressed Green's function to rank "+str(maxrank)+" (relative error "+str(err)+")")
+
+def constructGramEngine(green, distribution):
+    """
+    Construct the Gram matrix likeness engine, after
+    broadcasting the real image to all processes.
+
+    green:        Green's function of this process.
+    distribution: Distribution function to evaluate.
+    """
+    global realImage, weights
+
+    image = SMPI.getBuffer('realimage', (green.getImageSize(),))
+
+    if SMPI.rank() == SMPI.ROOT_PROC:
+        images = realImage if isinstance(realImage, list) else [realImage]
+        if not all(isinstance(img, np.ndarray) for img in images):
+            smutil.error("The 'gram' likeness engine requires the image to compare to.")
+
+        image[:] = np.reshape(green.maskImage(realImage), (image.size,))
+
+    SMPI.Bcast(image)
+
+    # Weight of each pixel in the (mean-squared error) likeness
+    W = np.concatenate([np.full((Ik.size,), w/Ik.size) for w, Ik in zip(weights, green.splitImage(image))])
+
+    return GramEngine(green, distribution, image, W)
+
 def loadConfiguration(conf):
     """
     Load the configuration file with name 'conf'.
@@ -191,13 +485,92 @@ def loadConfiguration(conf):
                 smutil.error("The type of the distribution function '"+dfname+"' has not been specified.")
 
     # Verify format if Green's function name
+    # (several diagnostics are given as comma-separated lists)
     if 'green' not in config['general']:
         smutil.error("No filename provided for the Green's function.")
-    if '#d' not in config['general']['green']:
-        smutil.error("Green's function filename has invalid format. Expected '#d' to occur in name.")
+    ndiagnostics = len(getList(config['general']['green']))
+    for bname in getList(config['general']['green']):
+        if '#d' not in bname and not os.path.isfile(bname):
+            smutil.error("The Green's function '"+bname+"' does not exist.")
+
+    # How to balance a single Green's function across processes
+    if 'balance' not in config['general']:
+        config['general']['balance'] = 'columns'
+    elif config['general']['balance'] not in BALANCE_MODES:
+        smutil.error("Unrecognized Green's function balancing mode: '"+config['general']['balance']+"'.")
 
     if 'image' not in config['general']:
         smutil.error("No truthful image provided.")
+    elif len(getList(config['general']['image'])) != ndiagnostics:
+        smutil.error("The number of images does not match the number of Green's functions.")
+    if 'mask' in config['general']:
+        masks = getList(config['general']['mask'])
+        if len(masks) != ndiagnostics:
+            smutil.error("The number of pixel masks does not match the number of Green's functions.")
+        for mask in masks:
+            if mask and not os.path.isfile(mask):
+                smutil.error("The pixel mask '"+mask+"' does not exist.")
+
+    # Weight of the likeness of each diagnostic
+    if 'weights' not in config['general']:
+        config['general']['weights'] = ', '.join(['1']*ndiagnostics)
+    elif len(getList(config['general']['weights'])) != ndiagnostics:
+        smutil.error("The number of weights does not match the number of Green's functions.")
+
+    # Incremental image updates
+    if 'incremental' not in config['general']:
+        config['general']['incremental'] = 'no'
+    if 'refresh' not in config['general']:
+        config['general']['refresh'] = '100'
+
+    # Blocked evaluation of the distribution function
+    if 'blocking' not in config['general']:
+        config['general']['blocking'] = 'no'
+    if 'blocksize' not in config['general']:
+        config['general']['blocksize'] = '4096'
+    if 'threads' not in config['general']:
+        config['general']['threads'] = '1'
+
+    # Pruning of negligible columns of the Green's function
+    if 'pruning' not in config['general']:
+        config['general']['pruning'] = '0'
+    elif float(config['general']['pruning']) < 0 or float(config['general']['pruning']) >= 1:
+        smutil.error("The pruning tolerance must be in the range [0, 1).")
+
+    # Green's function compression
+    if 'compression' not in config['general']:
+        config['general']['compression'] = 'none'
+    elif config['general']['compression'] not in COMPRESSION_MODES:
+        smutil.error("Unrecognized Green's function compression mode: '"+config['general']['compression']+"'.")
+    elif config['general']['compression'] == 'lowrank' and 'rank' not in config['general'] and 'tolerance' not in config['general']:
+        smutil.error("Low-rank compression requires the 'rank' and/or 'tolerance' option to be set.")
+
+    # How to compute the likeness
+    if 'engine' not in config['general']:
+        config['general']['engine'] = 'image'
+    elif config['general']['engine'] not in ENGINES:
+        smutil.error("Unrecognized likeness engine: '"+config['general']['engine']+"'.")
+
+    # Green's function load mode
+    if 'loadmode' not in config['general']:
+        config['general']['loadmode'] = 'memory'
+    elif config['general']['loadmode'] not in LOAD_MODES:
+        smutil.error("Unrecognized Green's function load mode: '"+config['general']['loadmode']+"'.")
+    elif config['general']['loadmode'] == 'stream' and config['general']['compression'] == 'lowrank':
+        smutil.error("Low-rank compression is not supported together with the 'stream' load mode.")
+    elif config['general']['loadmode'] == 'stream' and ndiagnostics > 1:
+        smutil.error("Several diagnostics are not supported together with the 'stream' load mode.")
+    # Precision of the Green's function multiplication
+    if 'precision' not in config['general']:
+        config['general']['precision'] = 'double'
+    elif config['general']['precision'] not in PRECISIONS:
+        smutil.error("Unrecognized precision: '"+config['general']['precision']+"'.")
+    # Memory budget (in MiB) for streaming the Green's function
+    if 'budget' not in config['general']:
+        config['general']['budget'] = '256'
+    # Verify the checksums of precompiled caches
+    if 'cacheverify' not in config['general']:
+        config['general']['cacheverify'] = 'no'
 
     return config
 
@@ -10,17 +10,55 @@ def compare(I1, I2):
     """
     return meanSquaredError(I1, I2)
 
+def compareGradient(I1, I2):
+    """
+    Derivative of 'compare()' with respect to
+    the elements of the image I1.
+    """
+    return meanSquaredErrorGradient(I1, I2)
+
+def compareWeighted(I1, I2, weights):
+    """
+    Combined likeness of several pairs of images (e.g.
+    of several diagnostics), i.e. the weighted sum
+
+       Sum_k weights[k] * compare(I1[k], I2[k])
+    """
+    return sum(w*compare(a, b) for w, a, b in zip(weights, I1, I2))
+
+def compareWeightedGradient(I1, I2, weights):
+    """
+    Derivative of 'compareWeighted()' with respect to the
+    elements of each of the images in I1. Returns a list
+    with one derivative per image.
+    """
+    return [w*compareGradient(a, b) for w, a, b in zip(weights, I1, I2)]
+
 def meanSquaredError(I1, I2):
     """
     Compute the mean-squared-error of the two images, i.e.
 
        err = 1/(m*n) Sum_i (Sum_j ( I1_ij - I2_ij )^2 )
+
+    (or the mean over all elements, if the images are
+    given as vectors of the pixels in a pixel mask).
     """
     if I1.shape != I2.shape:
         raise SmulException("Images are not of the same size")
 
     err = np.sum((I1 - I2)**2)
-    err /= I1.shape[0] * I1.shape[1]
+    err /= I1.size
 
     return err
 
+def meanSquaredErrorGradient(I1, I2):
+    """
+    Compute the derivative of the mean-squared-error
+    of the two images with respect to each element
+    of I1, i.e. 2/(m*n) * (I1_ij - I2_ij).
+    """
+    if I1.shape != I2.shape:
+        raise SmulException("Images are not of the same size")
+
+    return 2*(I1 - I2) / I1.size
+
@@ -0,0 +1,206 @@
+# Low-rank representation of a Green's function matrix
+#
+# Green's functions are smooth, and hence typically of low numerical
+# rank in pixel space. A (pixels x phase-space) matrix G is therefore
+# stored as the truncated singular value decomposition
+#
+#   G ~ U * diag(S) * Vt
+#
+# and multiplied with as U(S(Vt f)), which requires (pixels + n)*rank
+# rather than pixels*n memory and operations. The factorization is
+# computed using a randomized SVD, which only accesses G through
+# matrix-matrix products (and so works well with memory-mapped
+# Green's functions).
+
+import numpy as np
+
+class LowRankFunction:
+
+    # Make NumPy defer 'x @ G' to '__rmatmul__()' (rather than
+    # converting the function to a dense array with '__array__()')
+    __array_ufunc__ = None
+
+    def __init__(self, U, S, Vt, error2=0, norm2=None):
+        """
+        Constructor
+
+        U:      Left singular vectors (shape (pixels, rank)).
+        S:      Singular values (shape (rank,)).
+        Vt:     Right singular vectors (shape (rank, n)).
+        error2: Squared Frobenius norm of the truncation error.
+        norm2:  Squared Frobenius norm of the original matrix.
+        """
+        self.U  = np.ascontiguousarray(U)
+        self.S  = np.ascontiguousarray(S)
+        self.Vt = np.ascontiguousarray(Vt)
+
+        self.error2 = error2
+        self.norm2  = norm2 if norm2 is not None else np.sum(self.S**2) + error2
+
+    @property
+    def shape(self): return (self.U.shape[0], self.Vt.shape[1])
+    @property
+    def dtype(self): return self.U.dtype
+    @property
+    def itemsize(self): return self.U.itemsize
+    @property
+    def nbytes(self): return self.U.nbytes + self.S.nbytes + self.Vt.nbytes
+
+    def getRank(self): return self.S.size
+
+    def getRelativeError(self):
+        """
+        Returns the relative (Frobenius norm) error of
+        the low-rank approximation.
+        """
+        if self.norm2 == 0:
+            return 0.0
+
+        return np.sqrt(self.error2 / self.norm2)
+
+    def astype(self, dtype):
+        """
+        Returns a copy of this function with the singular
+        vectors and values stored in the given data type.
+        """
+        return LowRankFunction(self.U.astype(dtype), self.S.astype(dtype), self.Vt.astype(dtype), error2=self.error2, norm2=self.norm2)
+
+    def __array__(self, dtype=None, copy=None):
+        A = np.matmul(self.U * self.S, self.Vt)
+        return A if dtype is None else A.astype(dtype)
+
+    def __getitem__(self, key):
+        """
+        Select a range of columns, as in 'G[:,i0:i1]'.
+        """
+        if not isinstance(key, tuple) or len(key) != 2 or key[0] != slice(None):
+            raise IndexError("Only ranges of columns can be selected from a low-rank function.")
+
+        # (The truncation error of the selected
+        # columns alone is not known)
+        return LowRankFunction(self.U, self.S, self.Vt[:,key[1]])
+
+    def __matmul__(self, x):
+        """
+        Multiply from the right, G @ x, as U(S(Vt x)).
+        """
+        y = np.matmul(self.Vt, x)
+        if y.ndim == 1:
+            y *= self.S
+        else:
+            y *= self.S[:,None]
+
+        return np.matmul(self.U, y)
+
+    def __rmatmul__(self, x):
+        """
+        Multiply from the left, x @ G, as ((x U) S) Vt.
+        """
+        y = np.matmul(x, self.U)
+        y *= self.S
+
+        return np.matmul(y, self.Vt)
+
+    @staticmethod
+    def compress(A, rank=None, tolerance=None, oversampling=10, iterations=2, seed=0):
+        """
+        Compute a low-rank approximation of the matrix 'A'. Either
+        the rank of the approximation, or the largest acceptable
+        relative (Frobenius norm) error, must be given. In the latter
+        case, the rank is doubled until the tolerance is met.
+
+        A:            Matrix to compress (shape (pixels, n)).
+        rank:         Rank of the approximation.
+        tolerance:    Largest acceptable relative error.
+        oversampling: Number of extra random vectors to use when
+                      sampling the range of 'A'.
+        iterations:   Number of power iterations.
+        seed:         Seed of the random number generator.
+
+        RETURNS a LowRankFunction.
+        """
+        if rank is None and tolerance is None:
+            raise ValueError("Either the rank or the tolerance of the low-rank approximation must be given.")
+
+        P, n = A.shape
+        maxrank = min(P, n)
+        norm2 = np.linalg.norm(A)**2
+
+        k = rank if rank is not None else min(32, maxrank)
+        while True:
+            U, S, Vt = randomizedSVD(A, k, oversampling, iterations, seed)
+            if tolerance is None:
+                break
+
+            # Smallest rank meeting the tolerance
+            tail = norm2 - np.cumsum(S**2)
+            ok = np.flatnonzero(tail <= (tolerance**2)*norm2)
+            if ok.size > 0:
+                k = ok[0]+1 if rank is None else min(rank, ok[0]+1)
+                break
+            elif rank is not None or k >= maxrank:
+                break
+
+            k = min(2*k, maxrank)
+
+        k = min(k, S.size)
+        error2 = max(0.0, norm2 - np.sum(S[:k]**2))
+        return LowRankFunction(U[:,:k], S[:k], Vt[:k,:], error2=error2, norm2=norm2)
+
+def randomizedSVD(A, rank, oversampling=10, iterations=2, seed=0):
+    """
+    Compute the (approximate) leading singular triplets of the
+    matrix 'A' using a randomized range finder with power iterations.
+    Returns (U, S, Vt), with up to rank+oversampling triplets.
+
+    A:            Matrix to factorize.
+    rank:         Number of singular triplets sought.
+    oversampling: Number of extra random vectors to use.
+    iterations:   Number of power iterations.
+    seed:         Seed of the random number generator.
+    """
+    P, n = A.shape
+    l = min(rank + oversampling, P, n)
+    rng = np.random.default_rng(seed)
+
+    Q, _ = np.linalg.qr(np.matmul(A, rng.standard_normal((n, l))))
+    for i in range(0, iterations):
+        Z, _ = np.linalg.qr(np.matmul(Q.T, A).T)
+        Q, _ = np.linalg.qr(np.matmul(A, Z))
+
+    B = np.matmul(Q.T, A)
+    Ub, S, Vt = np.linalg.svd(B, full_matrices=False)
+
+    return np.matmul(Q, Ub), S, Vt
+
+
+########################
+# Unit test
+########################
+def test():
+    rng = np.random.default_rng(0)
+
+    A = np.matmul(rng.standard_normal((50, 8)), rng.standard_normal((8, 40)))
+    G = LowRankFunction.compress(A, rank=8)
+
+    x = rng.standard_normal((40,))
+    X = rng.standard_normal((3, 50))
+
+    # Products must never form the dense matrix
+    def array(self, dtype=None, copy=None):
+        raise AssertionError("The low-rank function was converted to a dense array.")
+
+    dense = LowRankFunction.__array__
+    LowRankFunction.__array__ = array
+    try:
+        assert np.allclose(G @ x, np.matmul(A, x))
+        assert np.allclose(X @ G, np.matmul(X, A))
+        assert np.allclose(X[0] @ G, np.matmul(X[0], A))
+    finally:
+        LowRankFunction.__array__ = dense
+
+    assert np.allclose(np.asarray(G), A)
+    print('OK')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,158 @@
+# Backend running smul across MPI processes (using mpi4py)
+
+from mpi4py import MPI
+import numpy as np
+
+from Backend import Backend, ROOT_PROC, SUM, MIN, MAX
+from SmulException import SmulException
+
+class MPIBackend(Backend):
+
+    def __init__(self, sharednode=False, replicas=1):
+        """
+        Constructor
+
+        sharednode: If True, arrays allocated with 'allocateShared()'
+                    are placed in MPI-3 shared memory windows, shared
+                    by all processes on the same node which allocate
+                    an array with the same key.
+        replicas:   Number of replica groups to split the processes
+                    into. Each group holds a complete copy of the
+                    Green's function (partitioned across the processes
+                    of the group) and can evaluate vectors independently
+                    of the other groups.
+        """
+        self.world = MPI.COMM_WORLD
+        self._worldRank = self.world.Get_rank()
+        self._ops = {SUM: MPI.SUM, MIN: MPI.MIN, MAX: MPI.MAX}
+
+        if self.world.Get_size() % replicas != 0:
+            raise SmulException("The number of processes ("+str(self.world.Get_size())+") must be a multiple of the number of replica groups ("+str(replicas)+").")
+
+        # Consecutive processes hold the same partition in
+        # different groups (and so are likely to share a node)
+        self._ngroups = replicas
+        self._group = self._worldRank % replicas
+        self.comm = self.world.Split(color=self._group, key=self._worldRank)
+        self._rank = self.comm.Get_rank()
+
+        self.nodecomm = None
+        self.windows = []
+        if sharednode:
+            self.nodecomm = self.world.Split_type(MPI.COMM_TYPE_SHARED, key=self._worldRank)
+
+    def abort(self):
+        self.world.Abort()
+
+    def allocateShared(self, key, shape, dtype):
+        """
+        Allocate an array in a shared memory window, shared with
+        all processes on this node allocating an array with the
+        same key. The process with the lowest rank among these
+        is responsible for filling the array. This function must
+        be called collectively by all processes on the node.
+        """
+        if self.nodecomm is None:
+            return super().allocateShared(key, shape, dtype)
+
+        # Group the processes of this node by key
+        keys = self.nodecomm.allgather(key)
+        subcomm = self.nodecomm.Split(color=keys.index(key), key=self.nodecomm.Get_rank())
+
+        dtype = np.dtype(dtype)
+        owner = (subcomm.Get_rank() == 0)
+        size = int(np.prod(shape)) * dtype.itemsize if owner else 0
+
+        win = MPI.Win.Allocate_shared(size, dtype.itemsize, comm=subcomm)
+        buf, itemsize = win.Shared_query(0)
+        self.windows.append((win, subcomm))
+
+        return np.ndarray(shape, dtype=dtype, buffer=buf), owner
+
+    def allgather(self, value):
+        return self.comm.allgather(value)
+
+    def allreduce(self, value, op):
+        return self.comm.allreduce(value, op=self._ops[op])
+
+    def finalize(self):
+        for win, subcomm in self.windows:
+            win.Free()
+            subcomm.Free()
+
+        self.windows = []
+
+    def Bcast(self, buf, root=ROOT_PROC):
+        self.comm.Bcast(buf, root=root)
+        return buf
+
+    def group(self):
+        return self._group
+
+    def groupRoot(self, group):
+        return group
+
+    def ngroups(self):
+        return self._ngroups
+
+    def worldRank(self):
+        return self._worldRank
+
+    def IrecvWorld(self, buf, src, tag):
+        return self.world.Irecv(buf, source=src, tag=tag)
+
+    def RecvWorld(self, buf, src, tag):
+        self.world.Recv(buf, source=src, tag=tag)
+        return buf
+
+    def SendWorld(self, buf, dest, tag):
+        self.world.Send(np.ascontiguousarray(buf), dest=dest, tag=tag)
+
+    def waitany(self, requests):
+        return MPI.Request.Waitany(requests)
+
+    def Ibcast(self, buf, root=ROOT_PROC):
+        return self.comm.Ibcast(buf, root=root)
+
+    def Ireduce(self, sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+        return self.comm.Ireduce(sendbuf, recvbuf, op=self._ops[op], root=root)
+
+    def nproc(self):
+        return self.comm.Get_size()
+
+    def rank(self):
+        return self._rank
+
+    def recv(self, src, tag):
+        return self.comm.recv(source=src, tag=tag)
+
+    def Recv(self, buf, src, tag):
+        self.comm.Recv(buf, source=src, tag=tag)
+        return buf
+
+    def Reduce(self, sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+        if recvbuf is not None and recvbuf is sendbuf and self._rank == root:
+            self.comm.Reduce(MPI.IN_PLACE, recvbuf, op=self._ops[op], root=root)
+        else:
+            self.comm.Reduce(np.ascontiguousarray(sendbuf), recvbuf, op=self._ops[op], root=root)
+
+        return recvbuf
+
+    def send(self, data, dest, tag):
+        self.comm.send(data, dest=dest, tag=tag)
+
+    def Send(self, buf, dest, tag):
+        self.comm.Send(np.ascontiguousarray(buf), dest=dest, tag=tag)
+
+    def synchronizeShared(self):
+        if self.nodecomm is None:
+            return
+
+        for win, subcomm in self.windows:
+            win.Sync()
+
+        self.nodecomm.Barrier()
+
+        for win, subcomm in self.windows:
+            win.Sync()
+
@@ -0,0 +1,141 @@
+# Backend running smul in a single (root) process, which
+# parallelizes the Green's function multiplication across
+# a pool of local worker processes.
+#
+# The Green's function matrix is moved into a block of shared
+# memory, which the workers map without copying. Each worker
+# multiplies a contiguous block of radial points, and the
+# resulting partial images are summed in the root process.
+
+import copy
+import multiprocessing
+import numpy as np
+import os
+from multiprocessing import shared_memory
+
+from SerialBackend import SerialBackend
+
+# State of the worker processes
+_greens = None
+_distributions = None
+_shm = None
+
+def _initWorker(template, distribution, shmname, shape, dtype, ranges):
+    """
+    Initialize a worker process by mapping the shared
+    Green's function and constructing the Green's and
+    distribution functions for each block of radii.
+    """
+    global _greens, _distributions, _shm
+
+    green = copy.copy(template)
+
+    # (A compressed Green's function is copied to the
+    # workers rather than placed in shared memory)
+    if shmname is not None:
+        _shm = shared_memory.SharedMemory(name=shmname)
+        green.FUNC = np.ndarray(shape, dtype=dtype, buffer=_shm.buf).T
+
+    _greens, _distributions = [], []
+    for i0, i1 in ranges:
+        gf = green.getRadialSlice(i0, i1)
+        df = copy.copy(distribution)
+        df.setGreenRadialGrid(gf.getSmallR())
+
+        _greens.append(gf)
+        _distributions.append(df)
+
+def _multiplyBlock(args):
+    """
+    Multiply the given block of the Green's function
+    with the distribution function specified by 'v'.
+    """
+    global _greens, _distributions
+
+    i, v, batch = args
+    if batch:
+        return _greens[i].multiplyBatch(_distributions[i], v)
+    else:
+        return _greens[i].multiply(_distributions[i], v)
+
+class MultiprocessingBackend(SerialBackend):
+
+    def __init__(self, processes=None):
+        """
+        Constructor
+
+        processes: Number of worker processes to use. If
+                   None, one per CPU is used.
+        """
+        if processes is None:
+            processes = os.cpu_count()
+
+        self.processes = processes
+        self.pool = None
+        self.shm = None
+        self.nblocks = 0
+        self.green = None
+
+    def setup(self, green, distribution):
+        """
+        Move the Green's function matrix into shared memory
+        and start the worker processes.
+        """
+        FUNC = green.getFunction()
+        npixels2, n = FUNC.shape
+
+        ranges = [(int(b[0]), int(b[-1])+1) for b in np.array_split(np.arange(green.getNR()), min(self.processes, green.getNR()))]
+        self.nblocks = len(ranges)
+        self.green = green
+
+        template = copy.copy(green)
+
+        if not isinstance(FUNC, np.ndarray):
+            initargs = (template, distribution, None, None, None, ranges)
+        else:
+            # Store the matrix as (phase-space x pixels), so that
+            # each block of radii is contiguous in memory
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, FUNC.nbytes))
+            M = np.ndarray((n, npixels2), dtype=FUNC.dtype, buffer=self.shm.buf)
+            M[:] = FUNC.T
+            green.FUNC = M.T
+
+            template.FUNC = None
+            initargs = (template, distribution, self.shm.name, M.shape, M.dtype, ranges)
+
+        self.pool = multiprocessing.Pool(self.nblocks, initializer=_initWorker, initargs=initargs)
+
+    def finalize(self):
+        """
+        Stop the worker processes and release
+        the shared memory.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        if self.shm is not None:
+            self.green.FUNC = None
+            try:
+                self.shm.close()
+            except BufferError:
+                # Views of the Green's function are still alive
+                pass
+            self.shm.unlink()
+            self.shm = None
+
+    def multiply(self, green, distribution, v):
+        if self.pool is None:
+            return green.multiply(distribution, v)
+
+        images = self.pool.map(_multiplyBlock, [(i, v, False) for i in range(0, self.nblocks)])
+        return np.sum(images, axis=0)
+
+    def multiplyBatch(self, green, distribution, V):
+        if self.pool is None:
+            return green.multiplyBatch(distribution, V)
+
+        images = self.pool.map(_multiplyBlock, [(i, V, True) for i in range(0, self.nblocks)])
+        return np.sum(images, axis=0)
+
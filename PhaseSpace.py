@@ -0,0 +1,123 @@
+"""
+Compact representation of the phase-space grid on which
+a Green's function is defined.
+
+The phase-space is the tensor product of a radial grid and a
+momentum grid. Rather than expanding every coordinate to the
+full size nr*nmomentum, the radial and momentum grids are stored
+separately and exposed as broadcastable arrays of shape (nr, 1)
+and (1, nmomentum) respectively. Any expression combining them
+thus evaluates to an (nr, nmomentum) array, laid out in the same
+order as the columns of the Green's function (radius varies
+slowest).
+"""
+
+import hashlib
+import numpy as np
+
+class PhaseSpace:
+
+    def __init__(self, r, ppar, pperp, allocate=None, momentum=None):
+        """
+        Constructor
+
+        r:        Radial grid (vector of length nr).
+        ppar:     Parallel momentum in each point of the
+                  momentum grid (vector of length nmomentum).
+        pperp:    Perpendicular momentum in each point of
+                  the momentum grid (vector of length nmomentum).
+        allocate: Function used to allocate the momentum arrays
+                  (see 'GreensFunction'). The arrays are keyed by
+                  the contents of the momentum grid, so that
+                  processes with identical grids may share them.
+        momentum: Optional pre-computed (6, nmomentum) block of
+                  momentum quantities (as returned by
+                  'getMomentumBlock()'), which is used as-is. If
+                  given, 'ppar' and 'pperp' are ignored.
+        """
+        if momentum is not None:
+            ppar, pperp = momentum[0], momentum[1]
+
+        r     = np.asarray(r).flatten()
+        ppar  = np.asarray(ppar).flatten()
+        pperp = np.asarray(pperp).flatten()
+
+        if ppar.size != pperp.size:
+            raise ValueError("The parallel and perpendicular momentum grids must have the same number of points.")
+
+        self.nr   = r.size
+        self.nmom = ppar.size
+        self.n    = self.nr * self.nmom
+
+        self.smallR = r
+        self.R      = np.reshape(r, (self.nr, 1))
+
+        # All momentum arrays are stored in one block
+        if momentum is not None:
+            M, fill = momentum, False
+        elif allocate is None:
+            M, fill = np.empty((6, self.nmom)), True
+        else:
+            key = 'momentum:'+hashlib.sha1(ppar.tobytes() + pperp.tobytes()).hexdigest()
+            M, fill = allocate(key, (6, self.nmom), np.float64)
+
+        self.M     = M
+        self.PPAR  = M[0:1,:]
+        self.PPERP = M[1:2,:]
+        self.P2    = M[2:3,:]
+        self.P     = M[3:4,:]
+        self.GAMMA = M[4:5,:]
+        self.XI    = M[5:6,:]
+
+        # Derived momentum quantities (computed once
+        # per momentum point, independent of radius)
+        if fill:
+            self.PPAR[:]  = ppar
+            self.PPERP[:] = pperp
+            self.P2[:]    = self.PPAR**2 + self.PPERP**2
+            self.P[:]     = np.sqrt(self.P2)
+            self.GAMMA[:] = np.sqrt(1.0 + self.P2)
+            self.XI[:]    = self.PPAR / self.P
+
+    def getNR(self): return self.nr
+    def getNMomentum(self): return self.nmom
+    def getSize(self): return self.n
+    def getSmallR(self): return self.smallR
+    def getShape(self): return (self.nr, self.nmom)
+
+    def getMomentumBlock(self):
+        """
+        Returns the (6, nmomentum) block containing the momentum
+        arrays (PPAR, PPERP, P2, P, GAMMA, XI), in that order.
+        """
+        return self.M
+
+    def getRadialSlice(self, i0, i1):
+        """
+        Returns the phase-space consisting of the radial
+        points i0 <= i < i1 of this phase-space.
+        """
+        return PhaseSpace(self.smallR[i0:i1], None, None, momentum=self.M)
+
+    def astype(self, dtype):
+        """
+        Returns a copy of this phase-space with the
+        momentum arrays stored in the given data type.
+        """
+        return PhaseSpace(self.smallR, None, None, momentum=self.M.astype(dtype))
+
+    def getCoordinates(self):
+        """
+        Returns the broadcastable coordinate arrays
+        (R, PPAR, PPERP), of shapes (nr, 1), (1, nmomentum)
+        and (1, nmomentum) respectively.
+        """
+        return self.R, self.PPAR, self.PPERP
+
+    def getMomentumQuantities(self):
+        """
+        Returns the pre-computed momentum quantities
+        (GAMMA, P, P2, XI), each of shape (1, nmomentum).
+        """
+        return self.GAMMA, self.P, self.P2, self.XI
+
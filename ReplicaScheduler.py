@@ -0,0 +1,156 @@
+# Scheduling of likeness evaluations across replica groups
+#
+# When the processes are split into several replica groups (see the
+# 'replicas' option), each group holds a complete copy of the Green's
+# function and can generate images independently of the other groups.
+# The root process (which is the root of group 0) hands out vectors
+# to the roots of the other groups as they become idle, and evaluates
+# vectors using group 0 itself while waiting for the results.
+
+import collections
+import numpy as np
+
+import SMPI
+
+class LikenessFuture:
+    """
+    Result of an asynchronous likeness evaluation,
+    as returned by 'smul.evalLikenessAsync()'.
+    """
+
+    def __init__(self, scheduler, v):
+        self.scheduler = scheduler
+        self.v = v
+        self.likeness = None
+        self._done = False
+
+    def done(self):
+        """
+        Returns True if the likeness value is available.
+        """
+        return self._done
+
+    def result(self):
+        """
+        Returns the likeness value, waiting for
+        the evaluation to complete if necessary.
+        """
+        if not self._done:
+            self.scheduler.wait(self)
+
+        return self.likeness
+
+    def setResult(self, likeness):
+        self.likeness = likeness
+        self._done = True
+
+class ReplicaScheduler:
+
+    def __init__(self, evaluate, compare, shape):
+        """
+        Constructor
+
+        evaluate: Function computing the likeness of a vector
+                  using the processes of group 0.
+        compare:  Function computing the likeness of an image.
+        shape:    Shape of the images returned by the groups.
+        """
+        self.evaluate = evaluate
+        self.compare = compare
+        self.shape = shape
+
+        self.idle = list(range(1, SMPI.ngroups()))
+        self.queue = collections.deque()
+        # Futures being evaluated by remote groups, as
+        # group => (future, request, image)
+        self.running = {}
+
+    def submit(self, v):
+        """
+        Queue the vector 'v' for evaluation and
+        return a 'LikenessFuture' for its likeness.
+        """
+        future = LikenessFuture(self, np.array(v, dtype=np.float64))
+        self.queue.append(future)
+        self.dispatch()
+
+        return future
+
+    def dispatch(self):
+        """
+        Hand out queued vectors to idle groups.
+        """
+        while self.idle and self.queue:
+            group = self.idle.pop(0)
+            future = self.queue.popleft()
+
+            sendVector(future.v, group)
+
+            image = np.empty(self.shape)
+            request = SMPI.IrecvWorld(image, SMPI.groupRoot(group), SMPI.TAG_IMAGE)
+            self.running[group] = (future, request, image)
+
+    def complete(self):
+        """
+        Wait for any of the remote groups to return an image.
+        """
+        groups = list(self.running.keys())
+        i = SMPI.waitany([self.running[g][1] for g in groups])
+
+        future, request, image = self.running.pop(groups[i])
+        future.setResult(self.compare(image))
+
+        self.idle.append(groups[i])
+        self.dispatch()
+
+    def wait(self, future):
+        """
+        Wait for the given future to complete. While waiting,
+        queued vectors are evaluated by group 0.
+        """
+        while not future.done():
+            if future in self.queue:
+                self.queue.remove(future)
+                future.setResult(self.evaluate(future.v))
+            elif self.queue:
+                f = self.queue.popleft()
+                f.setResult(self.evaluate(f.v))
+            else:
+                self.complete()
+
+    def drain(self):
+        """
+        Wait for all submitted vectors to be evaluated.
+        """
+        while self.queue:
+            self.wait(self.queue[-1])
+
+        while self.running:
+            self.complete()
+
+def sendVector(v, group):
+    """
+    Send the vector 'v' to the root process of the given group.
+    The shape of 'v' is sent first, followed by its contents.
+    """
+    v = np.ascontiguousarray(v, dtype=np.float64)
+    shape = np.zeros((3,), dtype=np.int64)
+    shape[0] = v.ndim
+    shape[1:(1+v.ndim)] = v.shape
+
+    dest = SMPI.groupRoot(group)
+    SMPI.SendWorld(shape, dest, SMPI.TAG_INPUT_VECTOR_SHAPE)
+    SMPI.SendWorld(v, dest, SMPI.TAG_INPUT_VECTOR)
+
+def recvVector():
+    """
+    Receive a vector sent with 'sendVector()'
+    from the root process.
+    """
+    shape = SMPI.getBuffer('worldvectorshape', (3,), dtype=np.int64)
+    SMPI.RecvWorld(shape, SMPI.ROOT_PROC, SMPI.TAG_INPUT_VECTOR_SHAPE)
+
+    v = SMPI.getBuffer('worldvector', tuple(shape[1:(1+shape[0])]))
+    SMPI.RecvWorld(v, SMPI.ROOT_PROC, SMPI.TAG_INPUT_VECTOR)
+
+    return v
@@ -1,48 +1,322 @@
 # softmultiplier wrapper for MPI
+#
+# All communication in smul goes through this module, which
+# forwards it to one of the available execution backends:
+#
+#   mpi             -- Run across MPI processes (default)
+#   serial          -- Run in a single process, without MPI
+#   multiprocessing -- Run in a single process, parallelizing
+#                      the multiplication over a local process pool
 
-from mpi4py import MPI
 import numpy as np
 
-_comm = None
+from Backend import ROOT_PROC, SUM, MIN, MAX
+from SmulException import SmulException
+
+_backend = None
 _rank = None
 
-ROOT_PROC = 0
+# Available backends
+BACKENDS = ['mpi', 'serial', 'multiprocessing']
 
 # Tags
 TAG_GREENSFUNCTION_NAME  = 1
-TAG_INPUT_VECTOR         = 2
-TAG_IMAGE                = 3
-TAG_RADIAL_BOUNDS_LOCAL  = 4
-TAG_RADIAL_BOUNDS_GLOBAL = 5
+TAG_INPUT_VECTOR_SHAPE   = 2
+TAG_INPUT_VECTOR         = 3
+TAG_IMAGE                = 4
+
+# Preallocated buffers (see 'getBuffer()')
+_buffers = {}
 
 def abort():
-    global _comm
-    _comm.Abort()
+    global _backend
+    _backend.abort()
+
+def allocateShared(key, shape, dtype):
+    """
+    Allocate an array which may be shared with other processes
+    on the same node that allocate an array with the same key
+    (if supported and enabled by the backend). Returns a tuple
+    (array, fill), where 'fill' indicates whether this process
+    must fill the array with data. Shared arrays may only be
+    read after 'synchronizeShared()' has been called.
+
+    key:   String identifying the contents of the array.
+    shape: Shape of the array.
+    dtype: Data type of the array elements.
+    """
+    global _backend
+    return _backend.allocateShared(key, shape, dtype)
+
+def allgather(value):
+    """
+    Gather the (pickleable) value 'value' from all processes
+    and return the list of values (ordered by rank) on all
+    processes.
+    """
+    global _backend
+    return _backend.allgather(value)
+
+def allreduce(value, op):
+    """
+    Reduce the (pickleable) value 'value' over all
+    processes using the operation 'op' (SUM, MIN or MAX)
+    and return the result on all processes.
+    """
+    global _backend
+    return _backend.allreduce(value, op)
+
+def Bcast(buf, root=ROOT_PROC):
+    """
+    Broadcast the contents of the NumPy array 'buf'
+    from the process 'root' to all other processes. On
+    the other processes, 'buf' must be preallocated
+    with the correct shape.
+    """
+    global _backend
+    return _backend.Bcast(buf, root=root)
+
+def finalize():
+    """
+    Release any resources held by the backend.
+    """
+    global _backend
+    _backend.finalize()
+
+def getBackend():
+    global _backend
+    return _backend
+
+def group():
+    """
+    Returns the index of the replica group
+    this process belongs to.
+    """
+    global _backend
+    return _backend.group()
+
+def groupRoot(group):
+    """
+    Returns the world rank of the root process
+    of the given replica group.
+    """
+    global _backend
+    return _backend.groupRoot(group)
+
+def ngroups():
+    """
+    Returns the number of replica groups.
+    """
+    global _backend
+    return _backend.ngroups()
+
+def init(backend='mpi', **options):
+    """
+    Initialize the execution backend with the given name.
+
+    backend: Name of backend to use (one of BACKENDS).
+    options: Backend-specific options.
+    """
+    global _backend, _rank
+
+    if backend == 'mpi':
+        from MPIBackend import MPIBackend
+        _backend = MPIBackend(**options)
+    elif backend == 'serial':
+        from SerialBackend import SerialBackend
+        _backend = SerialBackend(**options)
+    elif backend == 'multiprocessing':
+        from MultiprocessingBackend import MultiprocessingBackend
+        _backend = MultiprocessingBackend(**options)
+    else:
+        raise SmulException("Unrecognized backend: '"+backend+"'.")
+
+    _rank = _backend.rank()
+
+def Ibcast(buf, root=ROOT_PROC):
+    """
+    Non-blocking version of 'Bcast()'. Returns a request
+    which must be completed with 'wait()' before 'buf'
+    is used.
+    """
+    global _backend
+    return _backend.Ibcast(buf, root=root)
+
+def getBuffer(name, shape, dtype=np.float64):
+    """
+    Returns a preallocated buffer with the given name, shape
+    and data type. The buffer is only reallocated if a buffer
+    of a different shape or type is requested under the same
+    name, so that repeated transfers of equally sized arrays
+    do not allocate any memory.
 
-def init():
-    global _comm, _rank
-    _comm = MPI.COMM_WORLD
-    _rank = _comm.Get_rank()
+    name:  Name identifying the buffer.
+    shape: Shape of the buffer.
+    dtype: Data type of the buffer elements.
+    """
+    global _buffers
+
+    buf = _buffers.get(name)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        _buffers[name] = buf
+
+    return buf
 
 def is_root():
+    """
+    Returns True if this is the root process of
+    the whole run (i.e. of replica group 0).
+    """
+    global _backend, ROOT_PROC
+    return (_backend.worldRank() == ROOT_PROC)
+
+def is_group_root():
+    """
+    Returns True if this is the root process
+    of its replica group.
+    """
     global _rank, ROOT_PROC
     return (_rank == ROOT_PROC)
 
+def IrecvWorld(buf, src, tag):
+    """
+    Post a non-blocking receive of a NumPy array from
+    the process with world rank 'src'. Returns a request.
+    """
+    global _backend
+    return _backend.IrecvWorld(buf, src, tag)
+
+def multiply(green, distribution, v):
+    """
+    Multiply the Green's function of this process with the
+    distribution function specified by the vector 'v', using
+    the resources of the backend.
+    """
+    global _backend
+    return _backend.multiply(green, distribution, v)
+
+def multiplyBatch(green, distribution, V):
+    """
+    Multiply the Green's function of this process with the
+    batch of distribution functions specified by the rows
+    of 'V', using the resources of the backend.
+    """
+    global _backend
+    return _backend.multiplyBatch(green, distribution, V)
+
 def nproc():
-    global _comm
-    return _comm.Get_size()
+    """
+    Returns the number of processes in the
+    replica group of this process.
+    """
+    global _backend
+    return _backend.nproc()
 
 def rank():
+    """
+    Returns the rank of this process within
+    its replica group.
+    """
     global _rank
     return _rank
 
-def recv(src, tag):
-    global _comm
-    data = _comm.recv(source=src, tag=tag)
+def RecvWorld(buf, src, tag):
+    """
+    Receive a NumPy array from the process with world
+    rank 'src' into the (preallocated) buffer 'buf'.
+    """
+    global _backend
+    return _backend.RecvWorld(buf, src, tag)
 
-    return data
+def recv(src, tag):
+    global _backend
+    return _backend.recv(src, tag)
 
 def send(data, dest, tag):
-    global _comm
-    _comm.send(data, dest=dest, tag=tag)
+    global _backend
+    _backend.send(data, dest, tag)
+
+def SendWorld(buf, dest, tag):
+    """
+    Send the NumPy array 'buf' to the process
+    with world rank 'dest'.
+    """
+    global _backend
+    _backend.SendWorld(buf, dest, tag)
+
+def setup(green, distribution):
+    """
+    Prepare the backend for multiplying the given Green's
+    function with the given distribution function.
+    """
+    global _backend
+    _backend.setup(green, distribution)
+
+def Reduce(sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+    """
+    Reduce the NumPy arrays 'sendbuf' over all processes
+    using the operation 'op', storing the result in
+    'recvbuf' on the process 'root'. 'recvbuf' is
+    ignored on all other processes. If 'recvbuf' is the
+    same array as 'sendbuf', the reduction is done in-place.
+    """
+    global _backend
+    return _backend.Reduce(sendbuf, recvbuf, op=op, root=root)
+
+def Ireduce(sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+    """
+    Non-blocking version of 'Reduce()' (which is never done
+    in-place). Returns a request which must be completed
+    with 'wait()' before either of the buffers is touched.
+    """
+    global _backend
+    return _backend.Ireduce(sendbuf, recvbuf, op=op, root=root)
+
+def Recv(buf, src, tag):
+    """
+    Receive a NumPy array into the (preallocated) buffer
+    'buf' without any serialization.
+    """
+    global _backend
+    return _backend.Recv(buf, src, tag)
+
+def Send(buf, dest, tag):
+    """
+    Send the contiguous NumPy array 'buf' without
+    any serialization.
+    """
+    global _backend
+    _backend.Send(buf, dest, tag)
+
+def synchronizeShared():
+    """
+    Wait until all arrays allocated with 'allocateShared()'
+    have been filled by their owners.
+    """
+    global _backend
+    _backend.synchronizeShared()
+
+def waitany(requests):
+    """
+    Wait for any of the given requests to complete.
+    Returns the index of the completed request.
+    """
+    global _backend
+    return _backend.waitany(requests)
+
+def wait(request):
+    """
+    Wait for the given non-blocking request to complete.
+    """
+    global _backend
+    _backend.wait(request)
+
+def worldRank():
+    """
+    Returns the rank of this process among all
+    processes (in all replica groups).
+    """
+    global _backend
+    return _backend.worldRank()
 
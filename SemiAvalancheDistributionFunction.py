@@ -21,18 +21,55 @@ where
 """
 
 from DistributionFunction import DistributionFunction
-import numpy.matlib
 import numpy as np
 import scipy.special
 
 np.seterr(divide='ignore', invalid='ignore')
 
 class SemiAvalancheDistributionFunction(DistributionFunction):
-    
+
+    NPARAMS = 4
+
     def __init__(self, nr, rmin, rmax, greenRadialGrid):
         super().__init__(nr, rmin, rmax, greenRadialGrid)
     
-    def Eval(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None):
+    def Prepare(self, gamma, p2, p, xi):
+        """
+        Pre-compute the momentum dependence of the logarithm of
+        the distribution function, stacked as the rows of the
+        (4, nmomentum) array [log(g); g; xi*p^2/g; 1], as well
+        as the factor p^2/g appearing in A.
+        """
+        P2G = p2 / gamma
+        # A*xi vanishes at p = 0, where xi is undefined
+        XIP2G = np.where(p2 > 0, xi*P2G, 0)
+        B = np.concatenate((np.log(gamma), gamma, XIP2G, np.ones(gamma.shape)), axis=0)
+
+        return B, P2G
+
+    def EvalLog(self, a, C, g0, B, P2G, out=None):
+        """
+        Evaluate the distribution function, without the factor
+        f0, in log space. The parameters 'a', 'C' and 'g0' are
+        given per radius (as arrays of shape (nr, 1)), and all
+        quantities which only depend on the parameters (such as
+        log(Gamma(a))) are thus only computed once per radius.
+
+        a, C, g0: Parameters of the distribution function.
+        B, P2G:   Pre-computed momentum quantities (see 'Prepare()').
+        out:      Array to store the result in (optional).
+        """
+        # Everything except log(A/(2*sinh(A))) is linear in
+        # the momentum quantities B and formed as one product
+        K = np.concatenate((a - 1, -1/g0, C, -(scipy.special.gammaln(a) + a*np.log(g0))), axis=1)
+        f = np.matmul(K, B, out=out)
+
+        f += logSinhc(C * P2G)
+        np.exp(f, out=f)
+
+        return f
+
+    def Eval(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None, out=None):
         """
         Evaluate the avalanche distribution function defined by the
         vector 'v' in the point(s) given by (r, ppar, pperp).
@@ -41,28 +78,111 @@ class SemiAvalancheDistributionFunction(DistributionFunction):
           [a0,a1,...,an,A0,A1,...,An,f00,f01,...,f0n,g00,g01,...,g0n]
         where the index corresponds to the given radii.
         """
-        V = self.PreprocessInputVector(v, len(r), nparams=4)
+        V = self.PreprocessInputVector(v, nparams=self.NPARAMS)
+        return self.EvalParameters(V, ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi, out=out)
 
+    def EvalParameters(self, V, ppar, pperp, gamma=None, p2=None, p=None, xi=None, out=None):
+        """
+        Evaluate the semi-analytical avalanche distribution function
+        for the pre-processed parameters V = [a; A; f0; g0], of
+        shape (4, nr, 1).
+        """
+        # Per-radius parameters, shape (nr, 1)
         a  = V[0,:]
         C  = V[1,:]
         f0 = V[2,:]
         g0 = V[3,:]
 
-        # Compute other momentum quantities (if necessary)
-        if p2 is None:    p2    = ppar**2 + pperp**2
-        if p is None:     p     = np.sqrt(p2)
-        if gamma is None: gamma = np.sqrt(1 + p2)
-        if xi is None:    xi    = ppar / p
+        B, P2G = self.GetInvariants(ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
 
-        Gamma = scipy.special.gamma(a)
-        A = C*p*p / gamma
+        f = self.EvalLog(a, C, g0, B, P2G, out=out)
+        f *= f0
 
-        fp  = 1/(Gamma*np.power(g0,a)) * np.power(gamma,a-1.0) * np.exp(-gamma/g0)
-        fxi = A/(2.0*np.sinh(A)) * np.exp(A*xi)
+        return f
 
-        f = f0 * fp * fxi
+    def EvalParametersGradient(self, V, Q, ppar, pperp, gamma=None, p2=None, p=None, xi=None):
+        """
+        Evaluate the gradient of sum(Q*f) with respect to the
+        pre-processed parameters V = [a; A; f0; g0]. Writing the
+        distribution function as f = f0 * E (see 'EvalLog()'),
 
-        return f
+          df/da  = f0 * (log(g) - digamma(a) - log(g0)) * E
+          df/dA  = f0 * (xi*p^2/g + p^2/g * h(A*p^2/g)) * E
+          df/df0 = E
+          df/dg0 = f0 * (g/g0^2 - a/g0) * E
+
+        where h(x) = 1/x - coth(x) is the derivative of
+        log(x / (2*sinh(x))).
+        """
+        a  = V[0,:]
+        C  = V[1,:]
+        f0 = V[2,:]
+        g0 = V[3,:]
+
+        B, P2G = self.GetInvariants(ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+        QE = self.EvalLog(a, C, g0, B, P2G)
+        QE *= Q
+
+        # Sums over momentum of Q*E*[log(g); g; xi*p^2/g; 1]
+        S = np.matmul(QE, B.T)
+        T = np.sum(QE * P2G * dLogSinhc(C * P2G), axis=1, keepdims=True)
+
+        G = np.empty((4,) + a.shape)
+        G[0] = f0*(S[:,0:1] - (scipy.special.digamma(a) + np.log(g0))*S[:,3:4])
+        G[1] = f0*(S[:,2:3] + T)
+        G[2] = S[:,3:4]
+        G[3] = f0*(S[:,1:2]/g0**2 - (a/g0)*S[:,3:4])
+
+        return G
+
+    def EvalSeparable(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None):
+        """
+        Evaluate the semi-analytical avalanche distribution function
+        in separated form f = s(r) * g(p), which is possible when
+        'a', 'A' and 'g0' are the same at every radius (so that only
+        'f0' varies). Returns (s, g), or None if the function is
+        not separable.
+        """
+        V = self.PreprocessInputVector(v, nparams=self.NPARAMS)
+
+        if not self.IsConstantInRadius(V[[0,1,3],:]):
+            return None
+
+        B, P2G = self.GetInvariants(ppar, pperp, gamma=gamma, p2=p2, p=p, xi=xi)
+
+        g = self.EvalLog(V[0,:1], V[1,:1], V[3,:1], B, P2G)
+
+        return V[2,:,0], np.reshape(g, (g.size,))
+
+def logSinhc(A):
+    """
+    Evaluate log(A / (2*sinh(A))) without overflowing for
+    large |A|, using that
+
+      log(A / (2*sinh(A))) = log|A| - |A| - log(1 - exp(-2|A|))
+
+    and that the limit at A = 0 is log(1/2).
+    """
+    X = np.abs(A)
+    zero = (X == 0)
+    X[zero] = 1
+
+    L = np.log(X) - X - np.log(-np.expm1(-2*X))
+    L[zero] = -np.log(2)
+
+    return L
+
+def dLogSinhc(A):
+    """
+    Evaluate the derivative of log(A / (2*sinh(A))), i.e.
+    1/A - coth(A), using its Taylor expansion -A/3 + A^3/45
+    close to A = 0 (where the difference cancels).
+    """
+    small = (np.abs(A) < 1e-3)
+    X = np.where(small, 1, A)
+
+    return np.where(small, -A/3 + A**3/45, 1/X - 1/np.tanh(X))
 
 
 ########################
@@ -0,0 +1,56 @@
+# Backend running smul in a single process, without MPI
+#
+# All collective operations are trivial, since this process
+# is the only one taking part in the run.
+
+import sys
+
+from Backend import Backend, ROOT_PROC, SUM
+from SmulException import SmulException
+
+class SerialBackend(Backend):
+
+    def abort(self):
+        self.finalize()
+        sys.exit(1)
+
+    def allgather(self, value):
+        return [value]
+
+    def allreduce(self, value, op):
+        return value
+
+    def Bcast(self, buf, root=ROOT_PROC):
+        return buf
+
+    def Ibcast(self, buf, root=ROOT_PROC):
+        return None
+
+    def Ireduce(self, sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+        recvbuf[:] = sendbuf
+        return None
+
+    def nproc(self):
+        return 1
+
+    def rank(self):
+        return ROOT_PROC
+
+    def recv(self, src, tag):
+        raise SmulException("There are no other processes to receive from.")
+
+    def Recv(self, buf, src, tag):
+        raise SmulException("There are no other processes to receive from.")
+
+    def Reduce(self, sendbuf, recvbuf, op=SUM, root=ROOT_PROC):
+        if recvbuf is not None and recvbuf is not sendbuf:
+            recvbuf[:] = sendbuf
+
+        return recvbuf
+
+    def send(self, data, dest, tag):
+        raise SmulException("There are no other processes to send to.")
+
+    def Send(self, buf, dest, tag):
+        raise SmulException("There are no other processes to send to.")
+
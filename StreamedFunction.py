@@ -0,0 +1,238 @@
+# Out-of-core representation of a Green's function matrix
+#
+# Green's functions which do not fit in memory (not even when
+# partitioned across all processes) are kept on disk, and streamed
+# through memory one block of phase-space points at a time whenever
+# they are multiplied with. The blocks are read into two alternating
+# buffers by a background I/O thread, so that the next block is read
+# from disk while the current one is being multiplied with. The size
+# of the blocks is chosen so that both buffers fit in a given memory
+# budget.
+
+import concurrent.futures
+import h5py
+import numpy as np
+import os
+
+# Default memory budget (in bytes) for the block buffers
+BUDGET = 256*1024*1024
+
+# Per-process state: the I/O thread, and the open files
+# (re-created in processes forked from this process)
+_pid = None
+_executor = None
+_files = {}
+
+def _getState():
+    global _pid, _executor, _files
+
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        _files = {}
+
+    return _executor, _files
+
+class StreamedFunction:
+
+    # Make NumPy defer 'x @ G' to '__rmatmul__()' (rather than
+    # reading the whole matrix into memory with '__array__()')
+    __array_ufunc__ = None
+
+    def __init__(self, filename, dataset, i0, i1, npixels2, dtype, budget=None, rows=None):
+        """
+        Constructor
+
+        filename: Name of the Green's function file.
+        dataset:  Name of the HDF5 dataset containing the matrix, or
+                  None if the file is a precompiled cache (see
+                  'GreensFunction.saveCache()').
+        i0, i1:   Range of phase-space points (rows of the on-disk
+                  (phase-space x pixels) matrix) represented.
+        npixels2: Number of pixels per row of the on-disk matrix.
+        dtype:    Data type of the on-disk matrix.
+        budget:   Memory budget (in bytes) for the block buffers.
+                  If None, BUDGET is used.
+        rows:     Indices of the pixels to include (e.g. the pixels
+                  in a pixel mask), or None to include all pixels.
+        """
+        self.filename = filename
+        self.dataset = dataset
+        self.i0, self.i1 = i0, i1
+        self.npixels2 = npixels2
+        self.budget = budget if budget is not None else BUDGET
+        self.rows = rows
+        self._dtype = np.dtype(dtype)
+
+    @property
+    def shape(self): return (self.npixels2 if self.rows is None else self.rows.size, self.i1-self.i0)
+    @property
+    def dtype(self): return self._dtype
+    @property
+    def itemsize(self): return self._dtype.itemsize
+    @property
+    def nbytes(self): return 0
+
+    def astype(self, dtype):
+        """
+        Returns a copy of this function which converts
+        the blocks to the given data type as they are read.
+        """
+        return StreamedFunction(self.filename, self.dataset, self.i0, self.i1, self.npixels2, dtype, self.budget, self.rows)
+
+    def getBlockSize(self):
+        """
+        Returns the number of phase-space points per block,
+        such that two blocks fit in the memory budget.
+        """
+        return max(1, self.budget // (2*self.npixels2*self.itemsize))
+
+    def getDataset(self):
+        """
+        Returns the on-disk matrix, as an HDF5 dataset or
+        memory-mapped array, opening the file if necessary.
+        """
+        executor, files = _getState()
+
+        key = (self.filename, self.dataset)
+        if key not in files:
+            if self.dataset is None:
+                # (imported here, as GreensFunction imports this module)
+                from GreensFunction import GreensFunction
+                files[key] = GreensFunction.openCache(self.filename)[3]
+            else:
+                files[key] = h5py.File(self.filename, 'r')[self.dataset]
+
+        return files[key]
+
+    def read(self, j0, j1, out):
+        """
+        Read the phase-space points j0 <= j < j1 (counted
+        from the start of the on-disk matrix) into 'out'.
+        """
+        from GreensFunction import GreensFunction
+        return GreensFunction.readPhaseSpaceRows(self.getDataset(), j0, j1, self.npixels2, out=out[:(j1-j0)])
+
+    def blocks(self):
+        """
+        Iterate over the matrix in blocks of phase-space points,
+        yielding tuples (j0, j1, B), where B is the (j1-j0, pixels)
+        block of the (phase-space x pixels) matrix for the
+        phase-space points j0 <= j < j1 (counted from the first
+        point of this function). The next block is read in the
+        background while the current block is used, and each
+        block is only valid until the next one is requested.
+        """
+        executor, files = _getState()
+
+        n = self.i1-self.i0
+        step = min(n, self.getBlockSize())
+        if n == 0:
+            return
+
+        buffers = [np.empty((step, self.npixels2), dtype=self.dtype) for i in range(0, 2)]
+        starts = list(range(self.i0, self.i1, step))
+
+        future = executor.submit(self.read, starts[0], min(self.i1, starts[0]+step), buffers[0])
+        for k in range(0, len(starts)):
+            B = future.result()
+
+            # Prefetch the next block into the other buffer
+            if k+1 < len(starts):
+                future = executor.submit(self.read, starts[k+1], min(self.i1, starts[k+1]+step), buffers[(k+1) % 2])
+
+            if self.rows is not None:
+                B = B[:,self.rows]
+
+            j0 = starts[k]-self.i0
+            yield j0, j0+B.shape[0], B
+
+    def __array__(self, dtype=None, copy=None):
+        A = np.empty(self.shape, dtype=self.dtype if dtype is None else dtype)
+        for j0, j1, B in self.blocks():
+            A[:,j0:j1] = B.T
+
+        return A
+
+    def __getitem__(self, key):
+        """
+        Select a range of columns and/or a set of pixels (rows),
+        as in 'G[:,i0:i1]' or 'G[pixels,:]'.
+        """
+        if not isinstance(key, tuple) or len(key) != 2 or not isinstance(key[1], slice) or key[1].step not in (None, 1):
+            raise IndexError("Only ranges of columns and sets of rows can be selected from a streamed function.")
+
+        i0, i1, _ = key[1].indices(self.i1-self.i0)
+        rows = self.rows
+        if not isinstance(key[0], slice) or key[0] != slice(None):
+            rows = np.arange(self.npixels2)[key[0]] if rows is None else rows[key[0]]
+
+        return StreamedFunction(self.filename, self.dataset, self.i0+i0, self.i0+max(i0, i1), self.npixels2, self.dtype, self.budget, rows)
+
+    def __matmul__(self, x):
+        """
+        Multiply from the right, G @ x, streaming
+        the matrix from disk.
+        """
+        x = np.asarray(x)
+        y = np.zeros((self.shape[0],) + x.shape[1:], dtype=np.result_type(self.dtype, x.dtype))
+
+        for j0, j1, B in self.blocks():
+            y += np.matmul(B.T, x[j0:j1])
+
+        return y
+
+    def __rmatmul__(self, x):
+        """
+        Multiply from the left, x @ G, streaming
+        the matrix from disk.
+        """
+        x = np.asarray(x)
+        y = np.empty(x.shape[:-1] + (self.shape[1],), dtype=np.result_type(self.dtype, x.dtype))
+
+        for j0, j1, B in self.blocks():
+            y[...,j0:j1] = np.matmul(x, B.T)
+
+        return y
+
+
+########################
+# Unit test
+########################
+def test():
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    A = rng.random((40, 30))
+
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, 'func.h5')
+        with h5py.File(filename, 'w') as f:
+            f['func'] = A
+
+        # (a budget of four rows per block)
+        G = StreamedFunction(filename, 'func', 0, 40, 30, A.dtype, budget=2*4*30*A.itemsize)
+
+        x = rng.random((40,))
+        X = rng.random((3, 30))
+
+        # Products must stream the matrix, never read it whole
+        def array(self, dtype=None, copy=None):
+            raise AssertionError("The streamed function was read into a dense array.")
+
+        dense = StreamedFunction.__array__
+        StreamedFunction.__array__ = array
+        try:
+            assert np.allclose(G @ x, np.matmul(A.T, x))
+            assert np.allclose(X @ G, np.matmul(X, A.T))
+            assert np.allclose(X[0] @ G, np.matmul(X[0], A.T))
+            assert np.allclose(X @ G[:,5:17], np.matmul(X, A[5:17].T))
+        finally:
+            StreamedFunction.__array__ = dense
+
+        assert np.allclose(np.asarray(G), A.T)
+
+    print('OK')
+
+if __name__ == '__main__':
+    test()
@@ -9,8 +9,23 @@ class UnitDistributionFunction(DistributionFunction):
     def __init__(self, nr, rmin, rmax, greenRadialGrid):
         super().__init__(nr, rmin, rmax, greenRadialGrid)
 
-    def Eval(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None):
-        f = np.zeros(r.shape)
-        f[np.where(ppar < 4)] = 1
+    def Eval(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None, out=None):
+        f = out
+        if f is None:
+            f = np.empty(np.broadcast(r, ppar).shape)
+
+        f.fill(0)
+        f[np.broadcast_to(ppar < 4, f.shape)] = 1
         return f
 
+    def EvalParameters(self, V, ppar, pperp, gamma=None, p2=None, p=None, xi=None, out=None):
+        return self.Eval(np.zeros((V.shape[1], 1)), ppar, pperp, None, out=out)
+
+    def EvalParametersGradient(self, V, Q, ppar, pperp, gamma=None, p2=None, p=None, xi=None):
+        return np.zeros((0, V.shape[1], 1))
+
+    def EvalSeparable(self, r, ppar, pperp, v, gamma=None, p2=None, p=None, xi=None):
+        g = np.zeros((ppar.size,))
+        g[np.where(np.reshape(ppar, (ppar.size,)) < 4)] = 1
+        return np.ones((r.size,)), g
+
@@ -0,0 +1,92 @@
+"""
+CHECK THE BACKEND OVERRIDE OF 'smul.initialize()'
+
+Usage: checkbackend.py
+
+Initializes smul with the 'serial' backend given as an override
+to 'smul.initialize()', for configuration files containing the
+options of the other backends, and checks that only the options
+of the serial backend are used (and that an invalid number of
+replica groups is rejected). Exits with a non-zero status if
+any configuration fails.
+"""
+
+import numpy as np
+import os
+import scipy.io
+import sys
+import tempfile
+import traceback
+sys.path.append('..')
+
+import smul
+import SMPI
+import Initialize
+from SmulException import SmulException
+from checkgradient import writeGreensFunction, NPIXELS
+
+# Options of the [general] section of each configuration to check
+CONFIGURATIONS = {
+    'mpi':             'backend = mpi\nsharednode = yes\n',
+    'mpi-replicas':    'backend = mpi\nsharednode = yes\nreplicas = 2\n',
+    'multiprocessing': 'backend = multiprocessing\nprocesses = 2\n',
+    'default':         'sharednode = yes\nreplicas = 2\n'
+}
+
+def writeConfiguration(filename, green, image, options):
+    """
+    Write a configuration file using the Green's function
+    'green', the image 'image' and the given options of the
+    [general] section.
+    """
+    with open(filename, 'w') as f:
+        f.write('[general]\ngreen = '+green+'\nimage = '+image+'\n'+options)
+        f.write('distribution = avalanche\n[avalanche]\ntype = avalanche\nnr = 4\n')
+
+def main():
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 1, 4)
+    v = np.concatenate([1+x, 1-0.8*x, 20+10*x])
+
+    failed = False
+    with tempfile.TemporaryDirectory() as d:
+        green = os.path.join(d, 'green.mat')
+        writeGreensFunction(green, rng)
+        image = os.path.join(d, 'image.mat')
+        scipy.io.savemat(image, {'z': rng.random((NPIXELS, NPIXELS))})
+
+        for cname, options in CONFIGURATIONS.items():
+            conf = os.path.join(d, cname+'.conf')
+            writeConfiguration(conf, green, image, options)
+
+            try:
+                name, opts = Initialize.getBackend(conf, backend='serial')
+                ok = (name == 'serial' and opts == {})
+
+                smul.initialize(conf, backend='serial')
+                ok = ok and type(SMPI.getBackend()).__name__ == 'SerialBackend'
+                ok = ok and np.isfinite(smul.evalLikeness(v))
+                smul.exit()
+            except Exception:
+                traceback.print_exc()
+                ok = False
+
+            failed = failed or not ok
+            print('%-16s %s' % (cname, 'OK' if ok else 'FAILED'))
+
+        # An invalid number of replica groups must be rejected
+        conf = os.path.join(d, 'invalid.conf')
+        writeConfiguration(conf, green, image, 'replicas = 0\n')
+        try:
+            Initialize.getBackend(conf, backend='serial')
+            ok = False
+        except SmulException:
+            ok = True
+
+        failed = failed or not ok
+        print('%-16s %s' % ('replicas = 0', 'OK' if ok else 'FAILED'))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
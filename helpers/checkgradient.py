@@ -0,0 +1,115 @@
+"""
+CHECK THE ADJOINT GRADIENT AGAINST FINITE DIFFERENCES
+
+Usage: checkgradient.py
+
+Writes a small synthetic Green's function to a temporary
+directory, and compares the gradient of the likeness computed
+adjointly by 'GreensFunction.gradient()' to central finite
+differences, for each distribution function with derivatives and
+for each way of storing the Green's function. Exits with a non-zero
+status if any relative error exceeds TOLERANCE.
+"""
+
+import h5py
+import numpy as np
+import os
+import sys
+import tempfile
+sys.path.append('..')
+
+from AvalancheDistributionFunction import AvalancheDistributionFunction
+from GreensFunction import GreensFunction
+from SemiAvalancheDistributionFunction import SemiAvalancheDistributionFunction
+import Likeness
+
+# Largest acceptable relative error of the gradient
+TOLERANCE = 1e-6
+
+# Size of the synthetic Green's function
+NPIXELS = 8
+NR = 6
+NPPAR, NPPERP = 6, 5
+# Number of radial points of the input vector
+NRV = 4
+
+def writeGreensFunction(filename, rng):
+    """
+    Write a random SOFT Green's function of format 'r12ij'.
+    """
+    def chars(s): return np.array([[ord(c)] for c in s], dtype=np.uint16)
+
+    with h5py.File(filename, 'w') as f:
+        f['func'] = rng.random((NR*NPPAR*NPPERP, NPIXELS*NPIXELS))
+        f['param1'] = np.reshape(np.linspace(5, 60, NPPAR), (NPPAR, 1))
+        f['param2'] = np.reshape(np.linspace(0.5, 10, NPPERP), (NPPERP, 1))
+        f['param1name'] = chars('ppar')
+        f['param2name'] = chars('pperp')
+        f['pixels'] = np.array([[NPIXELS]], dtype=np.float64)
+        f['r'] = np.reshape(np.linspace(0.68, 0.9, NR), (NR, 1))
+        f['format'] = chars('r12ij')
+
+def checkGradient(gf, df, v, R):
+    """
+    Returns the relative error of the adjoint gradient of
+    the likeness of the vector 'v' to the image 'R'.
+    """
+    def likeness(v):
+        return Likeness.compare(gf.multiply(df, v), R)
+
+    I = gf.multiply(df, v)
+    g = gf.gradient(df, v, Likeness.compareGradient(I, R))
+
+    fd = np.empty(v.shape)
+    for i in range(0, v.size):
+        h = 1e-6*max(1, abs(v[i]))
+        e = np.zeros(v.shape)
+        e[i] = h
+        fd[i] = (likeness(v+e) - likeness(v-e)) / (2*h)
+
+    return np.linalg.norm(g - fd) / np.linalg.norm(fd)
+
+def main():
+    rng = np.random.default_rng(0)
+    R = rng.random((NPIXELS, NPIXELS))
+
+    # (parameters varying with radius, so that the
+    # distribution functions are not separable)
+    x = np.linspace(0, 1, NRV)
+    distributions = {
+        'avalanche': (AvalancheDistributionFunction, np.concatenate([1+x, 1-0.8*x, 20+10*x])),
+        'semi':      (SemiAvalancheDistributionFunction, np.concatenate([2+x, 1-2*x, 1+x, 5+5*x]))
+    }
+
+    failed = False
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, 'green.mat')
+        writeGreensFunction(filename, rng)
+
+        storages = {
+            'dense':   lambda: GreensFunction(filename),
+            'chunked': lambda: GreensFunction(filename, loadmode='chunked'),
+            'lowrank': lambda: GreensFunction(filename),
+            'sparse':  lambda: GreensFunction(filename),
+            'stream':  lambda: GreensFunction(filename, loadmode='stream', budget=4096)
+        }
+
+        for sname, load in storages.items():
+            gf = load()
+            if sname == 'lowrank':
+                gf.compress(rank=NPIXELS*NPIXELS)
+            elif sname == 'sparse':
+                gf.sparsify()
+
+            for dname, (DF, v) in distributions.items():
+                df = DF(NRV, np.amin(gf.getSmallR()), np.amax(gf.getSmallR()), gf.getSmallR())
+                err = checkGradient(gf, df, v, R)
+
+                ok = err <= TOLERANCE
+                failed = failed or not ok
+                print('%-8s %-10s relative error %.3e  %s' % (sname, dname, err, 'OK' if ok else 'FAILED'))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
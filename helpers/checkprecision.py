@@ -0,0 +1,77 @@
+"""
+CHECK SEPARABLE PRODUCTS IN MIXED PRECISION
+
+Usage: checkprecision.py
+
+Writes a small synthetic Green's function to a temporary
+directory, and compares the images computed in mixed precision
+from a separable distribution function (see 'contractSeparable()')
+to those computed in double precision, for each way of storing the
+Green's function. The images must also have the same data type as
+those computed without separating the distribution function (see
+'multiplyBlocked()'). Exits with a non-zero status if any check
+fails.
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+sys.path.append('..')
+
+from AvalancheDistributionFunction import AvalancheDistributionFunction
+from GreensFunction import GreensFunction
+from checkgradient import writeGreensFunction, NRV
+
+# Largest acceptable relative error of the mixed-precision image
+TOLERANCE = 1e-5
+
+def main():
+    rng = np.random.default_rng(0)
+
+    # (only 'b' varies with radius, so that the
+    # distribution function is separable)
+    x = np.linspace(0, 1, NRV)
+    v = np.concatenate([np.ones(NRV), 1-0.8*x, 20*np.ones(NRV)])
+
+    failed = False
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, 'green.mat')
+        writeGreensFunction(filename, rng)
+
+        storages = {
+            'row-major':    lambda: GreensFunction(filename, loadmode='chunked'),
+            'column-major': lambda: GreensFunction(filename),
+            'lowrank':      lambda: GreensFunction(filename),
+            'sparse':       lambda: GreensFunction(filename),
+            'stream':       lambda: GreensFunction(filename, loadmode='stream', budget=4096)
+        }
+
+        for sname, load in storages.items():
+            gf = load()
+            if sname == 'lowrank':
+                gf.compress(rank=8)
+            elif sname == 'sparse':
+                gf.sparsify()
+
+            df = AvalancheDistributionFunction(NRV, np.amin(gf.getSmallR()), np.amax(gf.getSmallR()), gf.getSmallR())
+            r, ppar, pperp = gf.phaseSpace.getCoordinates()
+            if df.EvalSeparable(r, ppar, pperp, v) is None:
+                print('%-13s distribution function is not separable  FAILED' % sname)
+                failed = True
+                continue
+
+            I = gf.multiply(df, v)
+            gf.setPrecision('mixed')
+            Im = gf.multiply(df, v)
+            Ib = gf.multiplyBlocked(df, v)
+
+            err = np.linalg.norm(Im - I) / np.linalg.norm(I)
+            ok = err <= TOLERANCE and Im.dtype == Ib.dtype
+            failed = failed or not ok
+            print('%-13s relative error %.3e  dtype %-8s %s' % (sname, err, Im.dtype, 'OK' if ok else 'FAILED'))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+CONVERT A GREEN'S FUNCTION TO PRECOMPILED CACHE FILES
+
+Usage: mkcache.py GREEN OUTPUT [NPARTS [BALANCE]]
+
+Converts the SOFT Green's function GREEN to the precompiled
+cache format loaded by smul (see 'GreensFunction.saveCache()').
+If NPARTS > 1, the Green's function is split along the radial
+grid into NPARTS files, balancing either the number of 'columns'
+(default) or 'nonzeros' across them, and OUTPUT must contain '#d'
+(which is replaced by the index of each part). A single cache file
+may also be partitioned automatically by smul at startup.
+"""
+
+import h5py
+import numpy as np
+import sys
+sys.path.append('..')
+
+from GreensFunction import GreensFunction
+import Initialize
+
+if len(sys.argv) < 3 or len(sys.argv) > 5:
+    print(__doc__)
+    sys.exit(1)
+
+source, output = sys.argv[1], sys.argv[2]
+nparts = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+balance = sys.argv[4] if len(sys.argv) > 4 else 'columns'
+
+if nparts > 1 and '#d' not in output:
+    print("The output filename must contain '#d' when splitting the Green's function into several parts.")
+    sys.exit(1)
+if balance not in Initialize.BALANCE_MODES:
+    print("Unrecognized balancing mode: '"+balance+"'.")
+    sys.exit(1)
+
+with h5py.File(source, 'r') as matfile:
+    nr = matfile['r'].size
+    npixels2 = int(matfile['pixels'][0,0])**2
+    dset = matfile['func']
+    nmom = dset.size // (nr*npixels2)
+
+    if nr < nparts:
+        print("Unable to split Green's function with "+str(nr)+" radial points into "+str(nparts)+" parts.")
+        sys.exit(1)
+
+    if balance == 'nonzeros':
+        work = np.array([np.sum(GreensFunction.countNonzeros(dset, i*nmom, (i+1)*nmom, npixels2)) for i in range(0, nr)])
+    else:
+        work = np.full((nr,), nmom, dtype=np.int64)
+
+for i, radialRange in enumerate(Initialize.partitionWork(work, nparts)):
+    fname = output.replace('#d', str(i))
+    print('Writing radial points '+str(radialRange[0])+'-'+str(radialRange[1]-1)+' to '+fname)
+
+    green = GreensFunction(source, loadmode='chunked', radialRange=radialRange)
+    green.saveCache(fname, source={'filename': source, 'radialRange': list(radialRange)})
+
@@ -24,6 +24,12 @@ ROOT PROCESS:
 
     smul.exit()
 
+Independent vectors can be evaluated concurrently by replica groups
+using 'evalLikenessAsync()', which returns a future:
+
+    futures = [smul.evalLikenessAsync(v) for v in GetNewVectors()]
+    likeness = [f.result() for f in futures]
+
 OTHER PROCESSES:
     smul.waitForSignal()
 """
@@ -33,12 +39,22 @@ import sys
 
 import Initialize
 import Likeness
+import ReplicaScheduler
 import SMPI
 from SmulException import SmulException
 
 # Global variables
 END_VECTOR = [0.0]
 
+# Operations requested from the other processes
+OP_IMAGE    = 0     # Generate image(s) and send to root
+OP_LIKENESS = 1     # Evaluate likeness using the likeness engine
+OP_GRADIENT = 2     # Evaluate likeness and its gradient
+
+# Scheduler handing out vectors to replica groups
+# (created on the first call to 'evalLikenessAsync()')
+scheduler = None
+
 def abort(): SMPI.abort()
 
 def evalLikeness(v):
@@ -54,38 +70,244 @@ def evalLikeness(v):
     if not SMPI.is_root():
         raise SmulException("Only the root process may compute the likeness value.")
 
+    # Evaluate likeness without forming the image
+    if Initialize.engine is not None:
+        request = distributeVector(v, OP_LIKENESS)
+        likeness = Initialize.engine.evaluate(v)
+        SMPI.wait(request)
+
+        return likeness
+
     # Distribute input vector and generate image
-    I = generateImage(v)
+    I = generateImage(v, raw=True)
+
+    # Evaluate likeness (over the pixels in the mask)
+    likeness = compareImage(I)
+
+    return likeness
+
+def evalLikenessAndGradient(v):
+    """
+    Compute the likeness of the image resulting from the input
+    vector 'v' to the input image (as 'evalLikeness()'), together
+    with the gradient of the likeness with respect to 'v'. The
+    gradient is computed adjointly, at the cost of about one
+    additional multiplication with the (transposed) Green's function.
+    NOTE: This function should (can) only be called from the root MPI process!
+
+    v: Vector of values specifying how to generate the distribution function.
+
+    RETURNS a tuple (likeness, gradient), where 'gradient'
+    is a vector of the same length as 'v'.
+    """
+    # Make sure only the root process can call us
+    if not SMPI.is_root():
+        raise SmulException("Only the root process may compute the likeness value.")
+
+    v = np.asarray(v, dtype=np.float64)
+    request = distributeVector(v, OP_GRADIENT)
+    likeness, gradient = likenessGradient(v)
+    SMPI.wait(request)
+
+    return likeness, gradient
+
+def evalLikenessAsync(v):
+    """
+    Start computing the likeness corresponding to the input
+    vector 'v', without waiting for the result. If the processes
+    have been split into replica groups (see the 'replicas' option),
+    vectors are evaluated concurrently by idle groups. Otherwise,
+    the evaluation is carried out once the result is requested.
+    NOTE: This function should (can) only be called from the root MPI process!
+
+    v: Vector of values specifying how to generate the distribution function.
+
+    RETURNS a 'LikenessFuture', whose 'result()' method
+    returns the likeness value.
+    """
+    global scheduler
+
+    # Make sure only the root process can call us
+    if not SMPI.is_root():
+        raise SmulException("Only the root process may compute the likeness value.")
+
+    if scheduler is None:
+        scheduler = ReplicaScheduler.ReplicaScheduler(
+            evalLikeness, compareImage,
+            Initialize.green.getImageShape()
+        )
+
+    return scheduler.submit(v)
+
+def evalLikenessBatch(V):
+    """
+    Compute the likeness of the images resulting from each of
+    the input vectors in 'V' to the input image. The whole batch
+    is sent to the other processes at once, and the images are
+    generated using a single matrix-matrix product per process.
+    NOTE: This function should (can) only be called from the root MPI process!
+
+    V: Array of shape (k, len(v)), each row of which is a vector
+       of values specifying how to generate a distribution function.
+
+    RETURNS a vector of k likeness values.
+    """
+    # Make sure only the root process can call us
+    if not SMPI.is_root():
+        raise SmulException("Only the root process may compute the likeness value.")
+
+    # Evaluate likeness without forming the images
+    if Initialize.engine is not None:
+        V = np.atleast_2d(np.asarray(V, dtype=np.float64))
+        request = distributeVector(V, OP_LIKENESS)
+        likeness = Initialize.engine.evaluateBatch(V)
+        SMPI.wait(request)
 
-    # Evaluate likeness
-    likeness = Likeness.compare(I, Initialize.realImage)
+        return likeness
+
+    # Distribute input vectors and generate images
+    I = generateImages(V, raw=True)
+
+    # Evaluate likeness (over the pixels in the mask)
+    likeness = np.array([compareImage(img) for img in I])
 
     return likeness
 
+def compareImage(I):
+    """
+    Compute the likeness of the image 'I' (as returned by
+    'generateImage(v, raw=True)') to the input image. If the
+    Green's functions of several diagnostics are used, the
+    likeness is the weighted sum of the likeness values of
+    the images of the individual diagnostics.
+    """
+    green = Initialize.green
+    R = green.maskImage(Initialize.realImage)
+
+    return Likeness.compareWeighted(green.splitImage(I), green.splitImage(R), Initialize.weights)
+
 def exit():
-    global END_VECTOR
-    distributeVector(END_VECTOR)
+    global END_VECTOR, scheduler
+
+    if scheduler is not None:
+        scheduler.drain()
+
+    # Stop the other replica groups
+    for group in range(1, SMPI.ngroups()):
+        ReplicaScheduler.sendVector(END_VECTOR, group)
+
+    SMPI.wait(distributeVector(END_VECTOR))
+    SMPI.finalize()
+
+def distributeVector(v, operation=OP_IMAGE):
+    """
+    Broadcast the input vector (or batch of input vectors)
+    'v' to all other processes. The shape of 'v' (and the
+    operation to carry out) is broadcast first, followed by
+    its contents as a raw buffer.
+
+    v:         Input vector (or array of input vectors).
+    operation: Operation which the other processes should carry
+               out with 'v' (OP_IMAGE, OP_LIKENESS or OP_GRADIENT).
+
+    RETURNS the (non-blocking) request for the broadcast of
+    the contents of 'v', which must be completed with
+    'SMPI.wait()'.
+    """
+    v = np.ascontiguousarray(v, dtype=np.float64)
+    shape = SMPI.getBuffer('vectorshape', (4,), dtype=np.int64)
+    shape[:] = 0
+    shape[0] = v.ndim
+    shape[1:(1+v.ndim)] = v.shape
+    shape[3] = operation
+
+    SMPI.wait(SMPI.Ibcast(shape))
+    return SMPI.Ibcast(v)
 
-def distributeVector(v):
-    n = SMPI.nproc()
-    for i in range(1, n):
-        SMPI.send(v, i, SMPI.TAG_INPUT_VECTOR)
+def likenessGradient(v):
+    """
+    Compute the likeness corresponding to the vector 'v' and its
+    gradient with respect to 'v'. The image is summed on the root
+    process, which broadcasts the derivative of the likeness with
+    respect to the image (the residual). Every process then
+    back-projects the residual through its part of the Green's
+    function, and the partial gradients are summed on the root.
+    Must be called by all processes of the replica group.
+
+    RETURNS a tuple (likeness, gradient) on the root
+    process, and (None, None) on all other processes.
+    """
+    green = Initialize.green
+    shape = green.getImageShape()
+
+    I = np.ascontiguousarray(smul_do(Initialize.distribution, green, v), dtype=np.float64)
+    residual = SMPI.getBuffer('residual', shape)
+    likeness = None
+
+    if SMPI.is_group_root():
+        SMPI.Reduce(I, I)
 
-def getDfParameters():
+        I, R = green.splitImage(I), green.splitImage(green.maskImage(Initialize.realImage))
+        likeness = Likeness.compareWeighted(I, R, Initialize.weights)
+        residual[:] = np.concatenate(Likeness.compareWeightedGradient(I, R, Initialize.weights), axis=-1)
+    else:
+        SMPI.Reduce(I, None)
+
+    SMPI.Bcast(residual)
+
+    g = green.gradient(Initialize.distribution, v, residual)
+    if SMPI.is_group_root():
+        return likeness, SMPI.Reduce(g, g)
+    else:
+        SMPI.Reduce(g, None)
+        return None, None
+
+def postDfParameters():
+    """
+    Post a non-blocking receive for the shape of the next
+    vector of distribution function parameters. Returns
+    the request, to be passed to 'getDfParameters()'.
+    """
+    shape = SMPI.getBuffer('vectorshape', (4,), dtype=np.int64)
+    return SMPI.Ibcast(shape)
+
+def getDfParameters(request=None):
     """
     Wait for distribution function parameters to
     be sent from the root MPI process
+
+    request: Request returned by 'postDfParameters()'. If
+             None, a new request is posted.
+
+    RETURNS the vector of parameters and the operation
+    to carry out with it (OP_IMAGE, OP_LIKENESS or OP_GRADIENT).
     """
-    return SMPI.recv(SMPI.ROOT_PROC, SMPI.TAG_INPUT_VECTOR)
+    if request is None:
+        request = postDfParameters()
+
+    SMPI.wait(request)
+    shape = SMPI.getBuffer('vectorshape', (4,), dtype=np.int64)
+    operation = int(shape[3])
+
+    v = SMPI.getBuffer('vector', tuple(shape[1:(1+shape[0])]))
+    SMPI.wait(SMPI.Ibcast(v))
+
+    return v, operation
 
 def getGreensFunction(): return Initialize.green
 
-def generateImage(v):
+def generateImage(v, raw=False):
     """
     Generate an image corresponding to the input vector 'v'.
 
-    v: Input vector. How this vector is formatted depends on
-       what the distribution function used demands.
+    v:   Input vector. How this vector is formatted depends on
+         what the distribution function used demands.
+    raw: If True, and a pixel mask has been set, only the pixels
+         in the mask are returned (as a vector). Otherwise, the
+         full image is returned (with zeros outside of the mask).
+         If several diagnostics are used, a list with the image
+         of each diagnostic is returned (or, if 'raw' is True, a
+         vector with the pixels of all of them).
     """
     global END_VECTOR
 
@@ -97,43 +319,105 @@ def generateImage(v):
 
     # Distribute input vector
     print('Distributing vector to other processes')
-    distributeVector(v)
+    request = distributeVector(v)
 
     # Exit if this was an 'END_VECTOR'
     if np.array_equal(v, END_VECTOR):
+        SMPI.wait(request)
         print('Received end vector. Exiting.')
         return
 
-    # Do multiplication
+    # Do multiplication and sum partial images
     print('Constructing image...')
-    I = smul_do(Initialize.distribution, Initialize.green, v)
+    I = reduceImages(lambda: smul_do(Initialize.distribution, Initialize.green, v), Initialize.green.getImageShape())
+    SMPI.wait(request)
 
-    # Retrieve partial images
-    print('Retrieving images from other processes...')
-    n = SMPI.nproc()
-    #I1 = SMPI.recv(1, SMPI.TAG_IMAGE)
-    #I2 = SMPI.recv(2, SMPI.TAG_IMAGE)
-    #I3 = SMPI.recv(3, SMPI.TAG_IMAGE)
-    for i in range(1, n):
-        I += SMPI.recv(i, SMPI.TAG_IMAGE)
+    print('Returning final image')
+    if raw:
+        return I
+    else:
+        return Initialize.green.toImage(I)
 
+def generateImages(V, raw=False):
+    """
+    Generate the images corresponding to each of the input
+    vectors in 'V'.
 
-    print('Returning final image')
-    return I
+    V:   Array of shape (k, len(v)), each row of which is an input
+         vector. How these vectors are formatted depends on what the
+         distribution function used demands.
+    raw: If True, and a pixel mask has been set, only the pixels
+         in the mask are returned (see 'generateImage()').
+
+    RETURNS an array of shape (k, npixels, npixels) (or, if several
+    diagnostics are used, a list with one such array per diagnostic).
+    """
+    # Make sure only the root process can call us
+    if not SMPI.is_root():
+        raise SmulException("Only the root process may generate an image.")
+
+    V = np.atleast_2d(np.asarray(V, dtype=np.float64))
+    print('Generating images corresponding to '+str(V.shape[0])+' vectors')
+
+    # Distribute input vectors
+    print('Distributing vectors to other processes')
+    request = distributeVector(V)
+
+    # Do multiplication and sum partial images
+    print('Constructing images...')
+    I = reduceImages(lambda: smul_do_batch(Initialize.distribution, Initialize.green, V), (V.shape[0],) + Initialize.green.getImageShape())
+    SMPI.wait(request)
+
+    print('Returning final images')
+    if raw:
+        return I
+    else:
+        return Initialize.green.toImage(I)
 
-def initialize(config="", inputRealImage=True):
+def initialize(config="", inputRealImage=True, backend=None):
     """
     Initialize smul with the given configuration file.
 
-    config: Name of file to read configuration from.
-            (need not be provided to processes other
-            than the root process)
+    config:  Name of file to read configuration from.
+             (need not be provided to processes other
+             than the root process)
+    backend: Name of execution backend to use ('mpi', 'serial'
+             or 'multiprocessing'). If None, the backend is
+             taken from the configuration file.
     """
-    SMPI.init()
+    name, options = Initialize.getBackend(config, backend=backend)
+    SMPI.init(name, **options)
     rank = SMPI.rank()
 
     Initialize.initialize(config, inputRealImage=inputRealImage)
 
+def reduceImages(compute, shape):
+    """
+    Sum the partial images of all processes on the root
+    process. The (non-blocking) reduction of the images of
+    the other processes is posted before the root computes
+    its own partial image, so that the communication is
+    overlapped with the root's share of the work.
+
+    compute: Function computing the partial image of this process.
+    shape:   Shape of the image.
+    """
+    # The root contributes zero to the reduction,
+    # and adds its own image once it is done
+    zero = SMPI.getBuffer('zeroimage', shape)
+    zero.fill(0)
+
+    I = np.empty(shape)
+    request = SMPI.Ireduce(zero, I)
+
+    Iown = compute()
+
+    print('Retrieving images from other processes...')
+    SMPI.wait(request)
+    I += Iown
+
+    return I
+
 def smul_do(df, gf, v):
     """
     Multiply the given Green's function with the given
@@ -143,7 +427,44 @@ def smul_do(df, gf, v):
     gf: GreensFunction
     v:  Vector of parameters specifying distribution function shape
     """
-    return gf.multiply(df, v)
+    return SMPI.multiply(gf, df, v)
+
+def smul_do_batch(df, gf, V):
+    """
+    Multiply the given Green's function with a batch
+    of distribution functions.
+
+    df: DistributionFunction
+    gf: GreensFunction
+    V:  Array of vectors of parameters (one per row)
+        specifying distribution function shapes
+    """
+    return SMPI.multiplyBatch(gf, df, V)
+
+def serveReplicaGroup():
+    """
+    Receive vectors from the root MPI process, generate
+    the corresponding images using the processes of this
+    replica group and send the images back to the root
+    process, until the 'END_VECTOR' is received. This
+    function is called on the root of every replica group
+    but the first.
+    """
+    global END_VECTOR
+
+    shape = Initialize.green.getImageShape()
+
+    v = ReplicaScheduler.recvVector()
+    while not np.array_equal(v, END_VECTOR):
+        request = distributeVector(v)
+        I = reduceImages(lambda: smul_do(Initialize.distribution, Initialize.green, v), shape)
+        SMPI.wait(request)
+
+        SMPI.SendWorld(I, SMPI.ROOT_PROC, SMPI.TAG_IMAGE)
+        v = ReplicaScheduler.recvVector()
+
+    SMPI.wait(distributeVector(END_VECTOR))
+    SMPI.finalize()
 
 def waitForSignal():
     """
@@ -157,16 +478,49 @@ def waitForSignal():
     """
     global END_VECTOR
 
-    v = getDfParameters()
+    if SMPI.is_group_root():
+        serveReplicaGroup()
+        return
+
+    # Image currently being reduced onto the root process
+    pending, request = None, None
+
+    v, operation = getDfParameters()
     while not np.array_equal(v, END_VECTOR):
-        # Evaluate image
-        I = smul_do(Initialize.distribution, Initialize.green, v)
+        # Take part in evaluating the likeness
+        if operation == OP_LIKENESS:
+            if np.ndim(v) == 2:
+                Initialize.engine.evaluateBatch(v)
+            else:
+                Initialize.engine.evaluate(v)
+
+            v, operation = getDfParameters()
+            continue
+        # Take part in evaluating the likeness gradient
+        elif operation == OP_GRADIENT:
+            likenessGradient(v)
+
+            v, operation = getDfParameters()
+            continue
+
+        # Evaluate image (or batch of images)
+        if np.ndim(v) == 2:
+            I = smul_do_batch(Initialize.distribution, Initialize.green, v)
+        else:
+            I = smul_do(Initialize.distribution, Initialize.green, v)
+
+        # Add image to the sum on the root process
+        # (without waiting for the reduction to finish)
+        SMPI.wait(request)
+        # (in double precision, whatever the precision of the product)
+        pending = np.ascontiguousarray(I, dtype=np.float64)
+        request = SMPI.Ireduce(pending, None)
 
-        # Send image to root process
-        SMPI.send(data=I, dest=SMPI.ROOT_PROC, tag=SMPI.TAG_IMAGE)
+        # Fetch the next vector while the image is in flight
+        v, operation = getDfParameters()
 
-        # Wait for next vector
-        v = getDfParameters()
+    SMPI.wait(request)
+    SMPI.finalize()
 
 
 def main(argv):
@@ -182,7 +536,7 @@ def main(argv):
     try:
         initialize(argv[0])
 
-        if SMPI.rank() == SMPI.ROOT_PROC:
+        if SMPI.is_root():
             evalLikeness([1.0])
             exit()
         else: